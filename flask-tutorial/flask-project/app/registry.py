@@ -0,0 +1,155 @@
+"""
+蓝图注册表
+
+蓝图用导入路径和URL前缀声明，create_app可以一次全部导入注册（和原来一样），
+也可以用懒加载：启动时什么都不导入，某个前缀第一次有请求时才导入对应的蓝图。
+
+Flask不允许在处理过请求以后再往app上注册蓝图（别的线程正在用url_map匹配路由，改它不安全），
+所以懒加载用的是文档里“按路径分发”的办法：每个前缀第一次被访问时，新建一个只挂这个蓝图的
+小Flask应用，由一个WSGI中间件按前缀把请求转给它。小应用和主应用共用同一个config、extensions、
+请求钩子和错误处理（是同一个对象，不是拷贝，主应用之后再改也一样生效），
+但因为是不同的应用，url_for不能跨蓝图生成链接。
+
+每个蓝图导入和注册花了多少时间都会记下来，用timing_report(app)查看。
+"""
+import importlib
+import threading
+import time
+
+from flask import Flask
+
+
+class BlueprintSpec(object):
+    """一个蓝图的声明：import_path是'模块:属性'，比如'.app_1:app_1'"""
+
+    def __init__(self, import_path, url_prefix, package=None):
+        self.import_path = import_path
+        self.url_prefix = '/' + url_prefix.strip('/')
+        self.package = package
+
+    @property
+    def name(self):
+        return self.import_path.rpartition(':')[2]
+
+    def load(self):
+        """导入蓝图，返回(蓝图, 导入用的秒数)"""
+        module_name, _, attr = self.import_path.partition(':')
+        start = time.perf_counter()
+        module = importlib.import_module(module_name, self.package)
+        blueprint = getattr(module, attr)
+        return blueprint, time.perf_counter() - start
+
+
+# 懒加载的小应用直接用主应用的这些属性
+SHARED_ATTRIBUTES = (
+    'config', 'extensions', 'session_interface',
+    'before_request_funcs', 'after_request_funcs', 'teardown_request_funcs',
+    'teardown_appcontext_funcs', 'url_value_preprocessors', 'url_default_functions',
+    'template_context_processors', 'error_handler_spec',
+)
+
+
+def _record(app, spec, mode, import_s, register_s):
+    if not hasattr(app, 'blueprint_timings'):
+        app.blueprint_timings = []
+    app.blueprint_timings.append({
+        'name': spec.name,
+        'url_prefix': spec.url_prefix,
+        'mode': mode,
+        'import_ms': import_s * 1e3,
+        'register_ms': register_s * 1e3,
+    })
+
+
+class BlueprintRegistry(object):
+    """所有蓝图的声明，按顺序注册"""
+
+    def __init__(self, package=None):
+        self.package = package
+        self.specs = []
+
+    def add(self, import_path, url_prefix):
+        self.specs.append(BlueprintSpec(import_path, url_prefix, self.package))
+
+    def register_all(self, app):
+        """全部马上导入并注册，和原来的create_app一样"""
+        for spec in self.specs:
+            blueprint, import_s = spec.load()
+            start = time.perf_counter()
+            app.register_blueprint(blueprint, url_prefix=spec.url_prefix)
+            _record(app, spec, 'eager', import_s, time.perf_counter() - start)
+
+    def install_lazy(self, app):
+        """装上懒加载的中间件，返回它，可以调用preload()提前全部加载"""
+        dispatcher = LazyDispatcher(app, self.specs)
+        app.wsgi_app = dispatcher
+        app.lazy_blueprints = dispatcher
+        return dispatcher
+
+
+class LazyDispatcher(object):
+    """
+    按URL前缀分发的WSGI中间件，前缀第一次被访问时才导入蓝图、建对应的小应用。
+
+    其余的请求交给原来的app.wsgi_app。多个线程同时第一次访问同一个前缀时只会加载一次。
+    """
+
+    def __init__(self, app, specs):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        # 长的前缀先匹配
+        self.specs = sorted(specs, key=lambda spec: len(spec.url_prefix), reverse=True)
+        self.apps = {}
+        self.lock = threading.Lock()
+
+    def _load(self, spec):
+        sub_app = self.apps.get(spec.url_prefix)
+        if sub_app is not None:
+            return sub_app
+        with self.lock:
+            sub_app = self.apps.get(spec.url_prefix)
+            if sub_app is None:
+                blueprint, import_s = spec.load()
+                start = time.perf_counter()
+                sub_app = self._make_app()
+                # 前缀已经挪到SCRIPT_NAME里了，这里挂在根上
+                sub_app.register_blueprint(blueprint)
+                _record(self.app, spec, 'lazy', import_s, time.perf_counter() - start)
+                self.apps[spec.url_prefix] = sub_app
+        return sub_app
+
+    def _make_app(self):
+        # 静态文件还是由主应用处理
+        sub_app = Flask(self.app.import_name, static_folder=None)
+        for name in SHARED_ATTRIBUTES:
+            setattr(sub_app, name, getattr(self.app, name))
+        return sub_app
+
+    def preload(self):
+        """把所有蓝图都加载好，比如在pre-fork的主进程里调用，worker就不用各自再加载一遍"""
+        for spec in self.specs:
+            self._load(spec)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        for spec in self.specs:
+            prefix = spec.url_prefix
+            if path == prefix or path.startswith(prefix + '/'):
+                sub_app = self._load(spec)
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix
+                environ['PATH_INFO'] = path[len(prefix):]
+                return sub_app(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+
+def timing_report(app):
+    """启动和蓝图加载的耗时，每行一个蓝图"""
+    lines = []
+    create_ms = getattr(app, 'create_app_ms', None)
+    if create_ms is not None:
+        lines.append('create_app: %.2f ms' % create_ms)
+    for entry in getattr(app, 'blueprint_timings', []):
+        lines.append('%-10s %-10s %-5s import %.2f ms, register %.2f ms' % (
+            entry['name'], entry['url_prefix'], entry['mode'],
+            entry['import_ms'], entry['register_ms']))
+    return '\n'.join(lines)
@@ -1,8 +1,15 @@
-from app import create_app
+from app import create_app, timing_report
 from flask_script import Manager
 
 app = create_app()
 manager = Manager(app)
 
+
+@manager.command
+def startup():
+    """打印create_app和每个蓝图的导入、注册耗时"""
+    print(timing_report(app))
+
+
 if __name__ == '__main__':
     manager.run()
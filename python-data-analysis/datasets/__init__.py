@@ -0,0 +1,8 @@
+"""
+书里用到的数据集和解析它们的代码，每个数据集目录下有一个parse.py，公共的磁盘缓存在cache.py。
+
+这是一个包，parse.py之间通过相对导入共用cache.py，要在python-data-analysis目录下用-m运行：
+
+    python -m datasets.babynames.parse
+    python -m datasets.benchmark
+"""
@@ -0,0 +1,319 @@
+"""
+datasets下各个数据集加载和常用统计的性能测试
+
+在python-data-analysis目录下运行：
+
+    python -m datasets.benchmark                          # 跑一遍，打印结果
+    python -m datasets.benchmark -o results.json          # 结果保存成JSON
+    python -m datasets.benchmark --compare results.json   # 和之前保存的结果比较，变慢超过阈值就返回1
+    python -m datasets.benchmark --cases babynames,titanic
+
+每个用例是“加载 + 书里对应的一个统计”，在单独的子进程里跑，这样峰值RSS互不影响：
+先预热一遍并记下峰值RSS，再跑repeat遍取最快的一遍作为耗时（单次计时的噪声很容易超过比较的阈值），
+然后在tracemalloc下跑一遍记内存分配，最后在cProfile下跑一遍，记下累计时间最多的几个函数。带_cached的用例先把磁盘缓存准备好，测的是从缓存读的速度。
+"""
+
+import argparse
+import atexit
+import cProfile
+import importlib
+import io
+import json
+import os
+import platform
+import pstats
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_module(dataset):
+    """导入某个数据集目录下的parse.py"""
+    return importlib.import_module('.%s.parse' % dataset, __package__)
+
+
+def temp_dir():
+    """子进程退出时自动删掉的临时目录"""
+    path = tempfile.mkdtemp(prefix='dataset-bench-')
+    atexit.register(shutil.rmtree, path, True)
+    return path
+
+
+def temp_cache():
+    from .cache import DatasetCache
+    return DatasetCache(temp_dir())
+
+
+# 用例：每个函数做好准备工作，返回要测的那个无参函数
+
+def case_babynames():
+    babynames = load_module('babynames')
+
+    def run():
+        names = babynames.load().to_frame()
+        return names.pivot_table('births', index='year', columns='sex', aggfunc='sum', observed=True)
+    return run
+
+
+def case_babynames_cached():
+    babynames = load_module('babynames')
+    cache = temp_cache()
+    babynames.load_cached(cache=cache)
+
+    def run():
+        names = babynames.load_cached(cache=cache)
+        return names.trend('Mary', sex='F'), names.top(2010, 10)
+    return run
+
+
+def case_bitly_usagov():
+    bitly = load_module('bitly_usagov')
+
+    def run():
+        return bitly.aggregate().top_tz_by_os(10)
+    return run
+
+
+def case_movielens():
+    movielens = load_module('movielens')
+
+    def run():
+        ml = movielens.load()
+        if ml.ratings is not None:
+            data = ml.joined()
+            return data.pivot_table('rating', index='title', columns='gender', aggfunc='mean',
+                                    observed=True)
+        # 没有ratings.dat时统计每个题材有多少部电影
+        genres = ml.movies['genres'].to_numpy()
+        return {genre: int(((genres >> i) & 1).sum()) for i, genre in enumerate(ml.genres)}
+    return run
+
+
+def case_movielens_cached():
+    movielens = load_module('movielens')
+    cache = temp_cache()
+    movielens.load_cached(cache=cache)
+
+    def run():
+        ml = movielens.load_cached(cache=cache)
+        return ml.movies_with_genres('Animation', "Children's", match='all')
+    return run
+
+
+def case_mta_perf():
+    mta = load_module('mta_perf')
+
+    def run():
+        perf = mta.load_all()
+        return perf.groupby(['source', 'CATEGORY'], observed=True)['MONTHLY_ACTUAL'].mean()
+    return run
+
+
+def case_mta_perf_cached():
+    mta = load_module('mta_perf')
+    cache = temp_cache()
+    mta.load_all_cached(cache=cache)
+
+    def run():
+        perf = mta.load_all_cached(cache=cache)
+        return perf.groupby(['source', 'CATEGORY'], observed=True)['MONTHLY_ACTUAL'].mean()
+    return run
+
+
+def case_haiti():
+    haiti = load_module('haiti')
+
+    def run():
+        index = haiti.HaitiIndex.build()
+        return index.road_incident_counts(100.0), index.category_frame().sum()
+    return run
+
+
+def case_haiti_cached():
+    haiti = load_module('haiti')
+    index_path = os.path.join(temp_dir(), 'haiti_index.npz')
+    haiti.load(index_path)
+
+    def run():
+        index = haiti.load(index_path)
+        return index.within(-72.335, 18.539, 1000.0), index.nearest_road(-72.335, 18.539)
+    return run
+
+
+def case_titanic():
+    import pandas as pd
+    path = os.path.join(HERE, 'titanic', 'train.csv')
+
+    def run():
+        train = pd.read_csv(path)
+        return train.groupby(['Sex', 'Pclass'])['Survived'].mean()
+    return run
+
+
+def case_titanic_cached():
+    cache = temp_cache()
+    from .cache import read_csv
+    path = os.path.join(HERE, 'titanic', 'train.csv')
+    read_csv(path, cache=cache)
+
+    def run():
+        train = read_csv(path, cache=cache)
+        return train.groupby(['Sex', 'Pclass'], observed=True)['Survived'].mean()
+    return run
+
+
+CASES = {name[len('case_'):]: func for name, func in sorted(globals().items())
+         if name.startswith('case_')}
+
+
+def peak_rss():
+    """进程到目前为止的最大常驻内存，单位字节"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024 # Linux上单位是KB
+
+
+def hot_spots(func, top):
+    """cProfile下跑一遍，返回累计时间最多的top个函数"""
+    profiler = cProfile.Profile()
+    profiler.runcall(func)
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            'function': '%s:%d(%s)' % (os.path.relpath(filename, HERE) if filename.startswith(HERE)
+                                        else os.path.basename(filename), line, name),
+            'ncalls': ncalls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6),
+        })
+    rows.sort(key=lambda row: row['cumtime'], reverse=True)
+    return rows[:top]
+
+
+def run_case(name, top=15, repeat=5):
+    """在当前进程里跑一个用例，应该在单独的子进程里调用"""
+    func = CASES[name]()
+    rss_before = peak_rss()
+    func() # 预热：导入、文件进页缓存、第一次分配内存
+    rss = peak_rss()
+    walls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        walls.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        top_sites = tracemalloc.take_snapshot().statistics('lineno')[:5]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_s': min(walls),
+        'wall_median_s': sorted(walls)[len(walls) // 2],
+        'peak_rss_bytes': rss,
+        'rss_growth_bytes': rss - rss_before, # 准备工作（导入、建缓存）以外增加的峰值
+        'tracemalloc_peak_bytes': peak,
+        'tracemalloc_retained_bytes': current,
+        'retained_top': ['%s: %d bytes' % (stat.traceback, stat.size) for stat in top_sites],
+        'hot_spots': hot_spots(func, top),
+    }
+
+
+def run(cases, top=15, repeat=5):
+    results = {}
+    for name in cases:
+        # 每个用例一个新的子进程，峰值RSS和导入的模块都不会互相影响
+        output = subprocess.run([sys.executable, '-m', 'datasets.benchmark', '--run-case', name,
+                                 '--top', str(top), '--repeat', str(repeat)],
+                                check=True, stdout=subprocess.PIPE, cwd=os.path.dirname(HERE)).stdout
+        results[name] = json.loads(output)
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': results,
+    }
+
+
+METRICS = ('wall_s', 'peak_rss_bytes', 'tracemalloc_peak_bytes') # 都是越小越好
+
+
+def compare(old, new, threshold):
+    """
+    找出变差的用例。
+    返回[(用例, 指标, 旧值, 新值, 变化比例)]
+    """
+    regressions = []
+    for name, result in new['results'].items():
+        old_result = old['results'].get(name)
+        if not old_result:
+            continue
+        for metric in METRICS:
+            old_value, new_value = old_result.get(metric), result.get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = new_value / old_value - 1
+            if change > threshold:
+                regressions.append((name, metric, old_value, new_value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-o', '--output', help='结果保存到这个JSON文件')
+    parser.add_argument('--compare', help='和这个JSON文件里的结果比较')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='变差超过这个比例就算退化，默认0.2也就是20%%')
+    parser.add_argument('--cases', help='只跑这些用例，逗号分隔，可选：%s' % ', '.join(CASES))
+    parser.add_argument('--top', type=int, default=15, help='记录多少个cProfile热点函数')
+    parser.add_argument('--repeat', type=int, default=5, help='预热以后计时几遍，取最快的一遍')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        result = run_case(args.run_case, args.top, max(1, args.repeat))
+        json.dump(result, sys.stdout)
+        return 0
+
+    cases = args.cases.split(',') if args.cases else list(CASES)
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        parser.error('unknown cases: %s' % ', '.join(unknown))
+
+    report = run(cases, args.top, max(1, args.repeat))
+    print('%-20s %10s %12s %14s  %s' % ('case', 'wall(ms)', 'rss(MB)', 'alloc peak(MB)', 'hottest'))
+    for name, result in report['results'].items():
+        hottest = next((row['function'] for row in result['hot_spots']
+                        if 'benchmark.py' not in row['function']
+                        and not row['function'].startswith('~')), '')
+        print('%-20s %10.1f %12.1f %14.1f  %s' % (
+            name, result['wall_s'] * 1e3, result['peak_rss_bytes'] / 2 ** 20,
+            result['tracemalloc_peak_bytes'] / 2 ** 20, hottest))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old, report, args.threshold)
+        for name, metric, old_value, new_value, change in regressions:
+            print('REGRESSION %s %s: %.4g -> %.4g (%+.0f%%)' % (
+                name, metric, old_value, new_value, change * 100))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import collections
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# 常见的写法是records = [json.loads(line) for line in open(path)]，所有记录的dict都留在内存里，
+# 再整个交给DataFrame，其实分析时只用到tz、a、c这几个字段。这里一行一行地读，
+# 每行解析完马上只留下需要的字段，dict随即丢掉；文件按字节切成几块，分到多个进程里同时统计，
+# 每块的结果都是可以合并的计数，一遍读完就能得到时区、操作系统和国家的统计。
+# （试过用正则直接从每一行里抠字段，不解析整行，但是在CPython上比C实现的json.loads还慢。）
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PATH = os.path.join(HERE, 'example.txt')
+FIELDS = ('tz', 'a', 'c')
+
+
+def iter_records(path=PATH, fields=FIELDS, start=0, end=None):
+    """
+    逐行读，每一行只取出fields里的字段，返回元组，没有的字段是None。
+
+    start和end是字节位置，用来把一个文件分成几块：从start之后的第一个完整行开始，
+    读到开头不超过end的最后一行为止，所以相邻的两块不会重复也不会漏。
+    """
+    loads = json.loads
+    with open(path, 'rb') as f:
+        if start:
+            f.seek(start - 1)
+            f.readline() # start落在一行中间的话，这一行归前一块
+        offset = f.tell()
+        for line in f:
+            if end is not None and offset >= end:
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            record = loads(line)
+            yield tuple([record.get(field) for field in fields])
+
+
+def clean_tz(tz):
+    """和书里一样：没有tz字段的记为Missing，空字符串记为Unknown"""
+    if tz is None:
+        return 'Missing'
+    return tz or 'Unknown'
+
+
+def agent_os(agent):
+    return 'Windows' if 'Windows' in agent else 'Not Windows'
+
+
+class ClickStats(object):
+    """
+    一块数据的统计结果，两块的结果可以用merge或者+合并。
+
+    tz、os、country都是Counter；tz_os是(时区, 操作系统)的计数，只统计有a字段的记录。
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.tz = collections.Counter()
+        self.os = collections.Counter()
+        self.country = collections.Counter()
+        self.tz_os = collections.Counter()
+
+    def add(self, tz, agent, country):
+        self.records += 1
+        tz = clean_tz(tz)
+        self.tz[tz] += 1
+        if country is not None:
+            self.country[country] += 1
+        if agent is not None:
+            os_name = agent_os(agent)
+            self.os[os_name] += 1
+            self.tz_os[tz, os_name] += 1
+
+    def merge(self, other):
+        self.records += other.records
+        self.tz.update(other.tz)
+        self.os.update(other.os)
+        self.country.update(other.country)
+        self.tz_os.update(other.tz_os)
+        return self
+
+    def __add__(self, other):
+        return ClickStats().merge(self).merge(other)
+
+    def top_tz(self, n=10):
+        return self.tz.most_common(n)
+
+    def top_tz_by_os(self, n=10):
+        """
+        有a字段的记录里，总数最多的n个时区，每个时区再分Windows和Not Windows。
+
+        返回[(时区, {操作系统: 次数})]，按总数从大到小。
+        """
+        by_tz = collections.defaultdict(dict)
+        for (tz, os_name), count in self.tz_os.items():
+            by_tz[tz][os_name] = count
+        # 总数一样时按时区名字排，结果是确定的
+        ranked = sorted(by_tz.items(), key=lambda item: (-sum(item[1].values()), item[0]))
+        return ranked[:n]
+
+
+def aggregate_range(path=PATH, start=0, end=None):
+    stats = ClickStats()
+    add = stats.add
+    for tz, agent, country in iter_records(path, FIELDS, start, end):
+        add(tz, agent, country)
+    return stats
+
+
+def _ranges(path, chunk_bytes):
+    size = os.path.getsize(path)
+    return [(start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)] or [(0, 0)]
+
+
+def aggregate(path=PATH, processes=None, chunk_bytes=4 << 20):
+    """
+    一遍读完整个文件，返回ClickStats。
+
+    processes大于1时把文件按chunk_bytes切块，每块一个任务放到进程池里，最后把结果合并。
+    """
+    ranges = _ranges(path, chunk_bytes)
+    if processes is not None and processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            parts = executor.map(aggregate_range, [path] * len(ranges),
+                                 [r[0] for r in ranges], [r[1] for r in ranges])
+            stats = ClickStats()
+            for part in parts:
+                stats.merge(part)
+        return stats
+    stats = ClickStats()
+    for start, end in ranges:
+        stats.merge(aggregate_range(path, start, end))
+    return stats
+
+
+if __name__ == '__main__':
+    stats = aggregate(processes=4, chunk_bytes=256 << 10)
+    print(stats.top_tz(10))
+    print(stats.os)
+    for tz, counts in stats.top_tz_by_os(10):
+        print(tz, counts)
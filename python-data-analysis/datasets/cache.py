@@ -0,0 +1,302 @@
+"""
+数据集的列式缓存。
+
+每次分析都要把同样的XML、txt、csv重新解析一遍。这里把解析好的DataFrame按列存成.npy，
+字符串列做字典编码：所有字符串放进一个共享的字符串池，列里只存编码。
+下次加载时用mmap打开这些.npy，不用解析也不用拷贝，只要几毫秒。
+
+缓存按源文件的路径、修改时间、大小和内容哈希来判断是否有效：
+修改时间和大小都没变就直接用；变了的话再算一遍哈希，内容没变也照样用，变了就重新解析。
+
+    from datasets.cache import default_cache
+    frame = default_cache.load('mta_perf', paths, parse_func)
+"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DIRECTORY = os.environ.get('DATASET_CACHE_DIR', os.path.join(HERE, '.cache'))
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fingerprint(path):
+    st = os.stat(path)
+    return {'path': path, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+
+def fingerprint_sources(paths):
+    """源文件的绝对路径、修改时间、大小和内容哈希，和缓存一起存下来，之后交给sources_fresh检查"""
+    return [dict(_fingerprint(os.path.abspath(p)), hash=file_hash(p)) for p in paths]
+
+
+def sources_fresh(sources, paths):
+    """
+    fingerprint_sources存下来的sources和现在的paths对不对得上，返回(是否有效, sources是否更新过)。
+
+    修改时间和大小都没变就有效；修改时间变了的话（比如重新checkout）再算一遍哈希，
+    内容一样也算有效，并把sources里的修改时间更新掉，调用方可以存回去，下次就不用再算哈希了。
+    """
+    if [s['path'] for s in sources] != [os.path.abspath(p) for p in paths]:
+        return False, False
+    touched = False
+    for source in sources:
+        try:
+            current = _fingerprint(source['path'])
+        except OSError:
+            return False, False
+        if current['size'] != source['size']:
+            return False, False
+        if current['mtime_ns'] != source['mtime_ns']:
+            if file_hash(source['path']) != source['hash']:
+                return False, False
+            source['mtime_ns'] = current['mtime_ns']
+            touched = True
+    return True, touched
+
+
+class _StringPool(object):
+    """一张表里所有字符串列共用的字符串池，存成一段utf-8字节加一个偏移数组"""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, values):
+        ids = self.ids
+        out = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = ids.get(value)
+            if code is None:
+                code = ids[value] = len(self.strings)
+                self.strings.append(value)
+            out[i] = code
+        return out
+
+    def save(self, directory):
+        encoded = [s.encode('utf-8') for s in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        np.save(os.path.join(directory, 'strings.offsets.npy'), offsets)
+        with open(os.path.join(directory, 'strings.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+
+    @staticmethod
+    def load(directory):
+        """返回一个函数：给一组编码，返回对应的字符串数组"""
+        offsets = np.load(os.path.join(directory, 'strings.offsets.npy'))
+        with open(os.path.join(directory, 'strings.bin'), 'rb') as f:
+            blob = f.read()
+
+        def lookup(ids):
+            return np.array([blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in ids],
+                            dtype=object)
+        return lookup
+
+
+def _is_string_column(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.categories.map(type).isin([str]).all()
+    if series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+        values = series.dropna()
+        return values.map(type).eq(str).all()
+    return False
+
+
+def write_table(frame, directory):
+    """把frame按列写到directory里，返回列的描述"""
+    pool = _StringPool()
+    columns = []
+    for i, name in enumerate(frame.columns):
+        series = frame[name]
+        entry = {'name': name, 'file': 'col%d' % i}
+        if _is_string_column(series):
+            # 字符串列统一存成编码加取值，读回来是category
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                codes = series.cat.codes.to_numpy()
+                categories = series.cat.categories
+            else:
+                codes, categories = pd.factorize(series)
+            entry['kind'] = 'category'
+            entry['ordered'] = bool(getattr(series.dtype, 'ordered', False))
+            np.save(os.path.join(directory, entry['file'] + '.codes.npy'),
+                    codes.astype(np.int32 if len(categories) >= 1 << 15 else np.int16))
+            np.save(os.path.join(directory, entry['file'] + '.categories.npy'),
+                    pool.intern(list(categories)))
+        else:
+            values = series.to_numpy()
+            if values.dtype == object:
+                raise TypeError('column %r is neither numeric nor string' % name)
+            entry['kind'] = 'array'
+            np.save(os.path.join(directory, entry['file'] + '.npy'), values)
+        columns.append(entry)
+    pool.save(directory)
+    return columns
+
+
+def read_table(directory, columns, mmap=True):
+    """write_table的反过程，数值列和编码都是mmap出来的，不会拷贝"""
+    mmap_mode = 'r' if mmap else None
+    lookup = _StringPool.load(directory)
+    data = {}
+    for entry in columns:
+        path = os.path.join(directory, entry['file'])
+        if entry['kind'] == 'category':
+            codes = np.load(path + '.codes.npy', mmap_mode=mmap_mode)
+            categories = lookup(np.load(path + '.categories.npy'))
+            dtype = pd.CategoricalDtype(categories, ordered=entry['ordered'])
+            data[entry['name']] = pd.Categorical.from_codes(codes, dtype=dtype)
+        else:
+            data[entry['name']] = np.load(path + '.npy', mmap_mode=mmap_mode)
+    return pd.DataFrame(data, columns=[entry['name'] for entry in columns], copy=False)
+
+
+class DatasetCache(object):
+    """
+    解析结果的磁盘缓存，每个数据集一个目录：manifest.json加上每一列的.npy。
+
+    version是解析函数的版本号，解析逻辑改了以后加一，旧的缓存就会作废。
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, mmap=True):
+        self.directory = directory
+        self.mmap = mmap
+
+    def _entry_dir(self, name, paths):
+        digest = hashlib.blake2b('\0'.join(paths).encode('utf-8'), digest_size=8).hexdigest()
+        return os.path.join(self.directory, '%s-%s' % (name, digest))
+
+    def _read_manifest(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, 'manifest.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_fresh(self, manifest, paths, version, entry_dir):
+        if manifest is None:
+            return False
+        if manifest.get('format') != FORMAT_VERSION or manifest.get('version') != version:
+            return False
+        fresh, touched = sources_fresh(manifest['sources'], paths)
+        if touched:
+            self._write_manifest(entry_dir, manifest)
+        return fresh
+
+    def _write_manifest(self, directory, manifest):
+        path = os.path.join(directory, 'manifest.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, path)
+
+    def get(self, name, paths, version=0):
+        """缓存有效时返回DataFrame，否则返回None"""
+        paths = [os.path.abspath(p) for p in paths]
+        entry_dir = self._entry_dir(name, paths)
+        manifest = self._read_manifest(entry_dir)
+        if not self._is_fresh(manifest, paths, version, entry_dir):
+            return None
+        frame = read_table(entry_dir, manifest['columns'], self.mmap)
+        if manifest.get('index'):
+            frame = frame.set_index(manifest['index'])
+        return frame
+
+    def put(self, name, paths, frame, version=0):
+        paths = [os.path.abspath(p) for p in paths]
+        # 先记下源文件的状态再写，写的过程中源文件被改了的话下次会发现
+        sources = fingerprint_sources(paths)
+        index_names = None
+        if not isinstance(frame.index, pd.RangeIndex) or frame.index.start != 0 or frame.index.step != 1:
+            index_names = [n if n is not None else 'index' for n in frame.index.names]
+            frame = frame.reset_index(names=index_names)
+        os.makedirs(self.directory, exist_ok=True)
+        # 写到临时目录里，写完再整个换过去，别的进程不会读到写了一半的缓存
+        tmp_dir = tempfile.mkdtemp(prefix='.%s-' % name, dir=self.directory)
+        try:
+            columns = write_table(frame, tmp_dir)
+            self._write_manifest(tmp_dir, {
+                'format': FORMAT_VERSION,
+                'version': version,
+                'name': name,
+                'sources': sources,
+                'rows': len(frame),
+                'columns': columns,
+                'index': index_names,
+            })
+            self._install(tmp_dir, self._entry_dir(name, paths), paths, version)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def _install(self, tmp_dir, entry_dir, paths, version):
+        """
+        把写好的临时目录换成entry_dir。
+
+        两个进程同时第一次加载同一个数据集时，先换进去的那个赢；后来的发现已经有一份有效的缓存，
+        就把自己的临时目录扔掉，不去动别人的。过期的缓存先整个挪开再删，正在mmap读它的进程不受影响。
+        """
+        while True:
+            try:
+                os.rename(tmp_dir, entry_dir) # 目标已经存在而且不是空目录时会失败
+                return
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+            if self._is_fresh(self._read_manifest(entry_dir), paths, version, entry_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            trash = tempfile.mkdtemp(prefix='.stale-', dir=self.directory)
+            try:
+                os.rename(entry_dir, os.path.join(trash, 'entry'))
+            except FileNotFoundError:
+                pass # 别的进程已经挪走了
+            shutil.rmtree(trash, ignore_errors=True)
+
+    def load(self, name, paths, parse, version=0):
+        """
+        有缓存就直接读，没有就调用parse()解析一遍再存起来。
+
+        第一次返回的是parse()的结果，之后返回的是mmap出来的只读DataFrame，
+        字符串列都是category。
+        version是解析逻辑的版本号，解析代码改了以后加一，旧的缓存就会作废。
+        """
+        frame = self.get(name, paths, version)
+        if frame is not None:
+            return frame
+        frame = parse()
+        self.put(name, paths, frame, version)
+        return frame
+
+    def invalidate(self, name, paths):
+        entry_dir = self._entry_dir(name, [os.path.abspath(p) for p in paths])
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+default_cache = DatasetCache()
+
+
+def read_csv(path, cache=default_cache, **kwargs):
+    """带缓存的pandas.read_csv，比如titanic/train.csv；不同的参数分开缓存"""
+    options = json.dumps(kwargs, sort_keys=True, default=repr)
+    name = 'csv-%s-%s' % (os.path.basename(path),
+                          hashlib.blake2b(options.encode('utf-8'), digest_size=4).hexdigest())
+    return cache.load(name, [path], lambda: pd.read_csv(path, **kwargs))
@@ -0,0 +1,455 @@
+import json
+import math
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from ..cache import fingerprint_sources, sources_fresh
+
+# 书里是把CATEGORY拆开以后建一个全是0和1的DataFrame，查“某个点附近的事件”
+# 或者“每条路附近有多少事件”都只能整张表扫一遍。
+# 这里CATEGORY只拆一次，存成稀疏的CSR数组；事件点和PortAuPrince_Roads里的每一段路
+# 都放进一个均匀网格里，矩形、半径、最近的路这几种查询只看附近的几个格子。
+# 解析结果和网格一起存成一个.npz放在数据旁边，源文件没变的话下次直接读。
+# shapefile用struct和numpy直接读，不依赖pyshp。
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CSV_PATH = os.path.join(HERE, 'Haiti.csv')
+ROADS_PATH = os.path.join(HERE, 'PortAuPrince_Roads', 'PortAuPrince_Roads')
+INDEX_PATH = os.path.join(HERE, 'haiti_index.npz')
+
+# 书里筛掉海地以外的点用的范围，事件点的网格只覆盖这一块，外面的点都归到边上的格子里
+HAITI_BOUNDS = (-75.0, 18.0, -70.0, 20.0) # (最小经度, 最小纬度, 最大经度, 最大纬度)
+CELL_SIZE = 0.01 # 度，大约一公里
+# 路都在太子港附近，而且市中心很密，路段用一个只覆盖路的范围、格子更小的网格
+SEGMENT_CELL_SIZE = 0.002
+EARTH_RADIUS = 6371008.8 # 米
+
+INDEX_VERSION = 1
+
+
+# CATEGORY
+
+def to_cat_list(catstr):
+    stripped = (x.strip() for x in catstr.split(','))
+    return [x for x in stripped if x]
+
+
+def get_english(cat):
+    code, names = cat.split('.', 1)
+    if '|' in names:
+        names = names.split(' | ')[1]
+    return code, names.strip()
+
+
+def category_matrix(categories):
+    """
+    把CATEGORY一列变成CSR形式的稀疏矩阵，返回(indptr, indices, codes, names)。
+
+    第i行有的类别是codes[indices[indptr[i]:indptr[i+1]]]，codes按字符串排序，和书里一样。
+    不同的CATEGORY字符串只有几百种，每种只拆一次。
+    """
+    row_codes, uniques = pd.factorize(pd.Series(categories).fillna(''))
+    parsed = [[get_english(cat) for cat in to_cat_list(s)] for s in uniques]
+    english = dict(pair for cats in parsed for pair in cats)
+    codes = sorted(english)
+    position = {code: i for i, code in enumerate(codes)}
+    per_unique = [np.unique(np.array([position[code] for code, _ in cats], dtype=np.int32))
+                  for cats in parsed]
+    lengths = np.array([len(cols) for cols in per_unique], dtype=np.int64)[row_codes]
+    indptr = np.zeros(len(row_codes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    if len(row_codes):
+        indices = np.concatenate([per_unique[c] for c in row_codes] + [np.empty(0, np.int32)])
+    else:
+        indices = np.empty(0, dtype=np.int32)
+    return indptr, indices, np.array(codes), np.array([english[c] for c in codes])
+
+
+# shapefile
+
+def read_shp_polylines(path):
+    """
+    读一个折线（PolyLine，带Z或M的也行）shapefile，返回每一段线段。
+
+    返回(segments, record)：segments是(n, 4)的数组，每行是(x0, y0, x1, y1)；
+    record[i]是第i段属于第几条记录，和.dbf里的行对应。
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    file_code, = struct.unpack('>i', data[:4])
+    shape_type, = struct.unpack('<i', data[32:36])
+    if file_code != 9994:
+        raise ValueError('%s is not a shapefile' % path)
+    if shape_type not in (3, 13, 23):
+        raise ValueError('expected a polyline shapefile, got shape type %d' % shape_type)
+
+    segments, record = [], []
+    pos, index = 100, 0
+    while pos + 8 <= len(data):
+        _, length = struct.unpack('>ii', data[pos:pos + 8])
+        content = pos + 8
+        pos = content + length * 2
+        this_type, = struct.unpack('<i', data[content:content + 4])
+        if this_type != 0: # 0是空的记录
+            num_parts, num_points = struct.unpack('<ii', data[content + 36:content + 44])
+            parts = np.frombuffer(data, '<i4', num_parts, content + 44)
+            points = np.frombuffer(data, '<f8', num_points * 2,
+                                   content + 44 + 4 * num_parts).reshape(-1, 2)
+            # 相邻的两个点连成一段，但是不能跨过两个part的交界
+            keep = np.ones(max(num_points - 1, 0), dtype=bool)
+            keep[parts[1:] - 1] = False
+            segments.append(np.hstack([points[:-1], points[1:]])[keep])
+            record.append(np.full(int(keep.sum()), index, dtype=np.int32))
+        index += 1
+    if not segments:
+        return np.empty((0, 4)), np.empty(0, dtype=np.int32)
+    return np.vstack(segments), np.concatenate(record)
+
+
+def read_dbf(path, encoding='latin-1'):
+    """读.dbf属性表，字符列去掉两边的空格，数字列转成数字，已删除的记录保留为空行"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    count, header_length, record_length = struct.unpack('<IHH', data[4:12])
+    fields = []
+    pos = 32
+    while data[pos] != 0x0D:
+        name = data[pos:pos + 11].split(b'\0')[0].decode('ascii')
+        fields.append((name, chr(data[pos + 11]), data[pos + 16]))
+        pos += 32
+    dtype = np.dtype([('_deleted', 'S1')] + [(name, 'S%d' % size) for name, _, size in fields])
+    records = np.frombuffer(data, dtype, count, header_length)
+    columns = {}
+    for name, kind, _ in fields:
+        values = np.char.decode(np.char.strip(records[name]), encoding)
+        if kind in 'NF':
+            values = pd.to_numeric(values, errors='coerce')
+        columns[name] = values
+    frame = DataFrame(columns, columns=[name for name, _, _ in fields])
+    frame.loc[records['_deleted'] == b'*'] = None
+    return frame
+
+
+# 网格
+
+def _group(keys, size):
+    """按keys分组：第k组是order[offsets[k]:offsets[k+1]]"""
+    order = np.argsort(keys, kind='stable').astype(np.int32)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=size), out=offsets[1:])
+    return order, offsets
+
+
+class UniformGrid(object):
+    """
+    覆盖bounds的均匀网格，格子按列存放：第ix列第iy行的格子编号是ix * ny + iy，
+    所以一个矩形范围在每一列里是连续的一段，用一次切片就能取出来。
+
+    超出bounds的坐标归到边上的格子里，查询时再用精确的坐标过滤，结果不受影响。
+    """
+
+    def __init__(self, bounds, cell_size):
+        self.bounds = tuple(float(b) for b in bounds)
+        self.cell_size = float(cell_size)
+        x0, y0, x1, y1 = self.bounds
+        self.nx = max(1, int(math.ceil((x1 - x0) / cell_size)))
+        self.ny = max(1, int(math.ceil((y1 - y0) / cell_size)))
+
+    def cols(self, x):
+        return np.clip(np.floor((np.asarray(x) - self.bounds[0]) / self.cell_size),
+                       0, self.nx - 1).astype(np.int64)
+
+    def rows(self, y):
+        return np.clip(np.floor((np.asarray(y) - self.bounds[1]) / self.cell_size),
+                       0, self.ny - 1).astype(np.int64)
+
+    def cell_of(self, x, y):
+        """(x, y)所在格子的列和行，不截断，网格外面的点会是负数或者超出范围"""
+        return (int(math.floor((x - self.bounds[0]) / self.cell_size)),
+                int(math.floor((y - self.bounds[1]) / self.cell_size)))
+
+    def index_points(self, x, y):
+        return _group(self.cols(x) * self.ny + self.rows(y), self.nx * self.ny)
+
+    def index_boxes(self, minx, miny, maxx, maxy):
+        """每个矩形放进它覆盖的所有格子里"""
+        ix0, ix1 = self.cols(minx), self.cols(maxx)
+        iy0, iy1 = self.rows(miny), self.rows(maxy)
+        heights = iy1 - iy0 + 1
+        counts = (ix1 - ix0 + 1) * heights
+        item = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (ix0[item] + local // heights[item]) * self.ny + iy0[item] + local % heights[item]
+        order, offsets = _group(cells, self.nx * self.ny)
+        return item[order], offsets
+
+    def candidates(self, items, offsets, minx, miny, maxx, maxy):
+        """和矩形相交的格子里的所有东西，可能有重复，也可能有矩形外面的"""
+        return self.in_cells(items, offsets, int(self.cols(minx)), int(self.cols(maxx)),
+                             int(self.rows(miny)), int(self.rows(maxy)))
+
+    def in_cells(self, items, offsets, ix0, ix1, iy0, iy1):
+        """第ix0到ix1列、第iy0到iy1行的格子里的东西，网格外面的部分当作空的"""
+        ix0, ix1 = max(ix0, 0), min(ix1, self.nx - 1)
+        iy0, iy1 = max(iy0, 0), min(iy1, self.ny - 1)
+        if ix0 > ix1 or iy0 > iy1:
+            return items[:0]
+        chunks = [items[offsets[ix * self.ny + iy0]:offsets[ix * self.ny + iy1 + 1]]
+                  for ix in range(ix0, ix1 + 1)]
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+
+def haversine(lon0, lat0, lon, lat):
+    """两点之间的大圆距离，单位米"""
+    lon0, lat0, lon, lat = map(np.radians, (lon0, lat0, lon, lat))
+    a = (np.sin((lat - lat0) / 2) ** 2
+         + np.cos(lat0) * np.cos(lat) * np.sin((lon - lon0) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def _segment_distance(lon, lat, segments):
+    """点到每一段的距离（米），在点附近用等距圆柱投影近似，几公里以内足够准"""
+    kx = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(lat))
+    ky = math.radians(1) * EARTH_RADIUS
+    x0 = (segments[:, 0] - lon) * kx
+    y0 = (segments[:, 1] - lat) * ky
+    dx = (segments[:, 2] - lon) * kx - x0
+    dy = (segments[:, 3] - lat) * ky - y0
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length2 > 0, -(x0 * dx + y0 * dy) / length2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(x0 + t * dx, y0 + t * dy)
+
+
+class HaitiIndex(object):
+    """
+    事件点、类别矩阵、路段和网格索引。
+
+    lon、lat是每个事件的坐标，行号和Haiti.csv的行一一对应；
+    segments是所有路段，segment_road[i]是第i段属于.dbf里的哪一行。
+    """
+
+    ARRAYS = ('lon', 'lat', 'cat_indptr', 'cat_indices', 'cat_codes', 'cat_names',
+              'segments', 'segment_road', 'point_items', 'point_offsets',
+              'segment_items', 'segment_offsets')
+
+    def __init__(self, grid, segment_grid, **arrays):
+        self.grid = grid
+        self.segment_grid = segment_grid
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.csv_path = CSV_PATH
+        self.roads_path = ROADS_PATH
+        self._incidents = None
+        self._roads = None
+        self._category_rows = None
+
+    @classmethod
+    def build(cls, csv_path=CSV_PATH, roads_path=ROADS_PATH,
+              bounds=HAITI_BOUNDS, cell_size=CELL_SIZE, segment_cell_size=SEGMENT_CELL_SIZE):
+        frame = pd.read_csv(csv_path)
+        lon = frame['LONGITUDE'].to_numpy(dtype=np.float64)
+        lat = frame['LATITUDE'].to_numpy(dtype=np.float64)
+        indptr, indices, codes, names = category_matrix(frame['CATEGORY'])
+        segments, segment_road = read_shp_polylines(roads_path + '.shp')
+        grid = UniformGrid(bounds, cell_size)
+        point_items, point_offsets = grid.index_points(lon, lat)
+        minx = np.minimum(segments[:, 0], segments[:, 2])
+        miny = np.minimum(segments[:, 1], segments[:, 3])
+        maxx = np.maximum(segments[:, 0], segments[:, 2])
+        maxy = np.maximum(segments[:, 1], segments[:, 3])
+        if len(segments):
+            road_bounds = (minx.min(), miny.min(), maxx.max(), maxy.max())
+        else:
+            road_bounds = bounds
+        segment_grid = UniformGrid(road_bounds, segment_cell_size)
+        segment_items, segment_offsets = segment_grid.index_boxes(minx, miny, maxx, maxy)
+        index = cls(grid, segment_grid, lon=lon, lat=lat, cat_indptr=indptr, cat_indices=indices,
+                    cat_codes=codes, cat_names=names, segments=segments,
+                    segment_road=segment_road, point_items=point_items,
+                    point_offsets=point_offsets, segment_items=segment_items,
+                    segment_offsets=segment_offsets)
+        index.csv_path, index.roads_path = csv_path, roads_path
+        index._incidents = frame
+        return index
+
+    # 存取
+
+    def save(self, path, sources):
+        meta = {'version': INDEX_VERSION, 'bounds': self.grid.bounds,
+                'cell_size': self.grid.cell_size, 'segment_bounds': self.segment_grid.bounds,
+                'segment_cell_size': self.segment_grid.cell_size, 'sources': sources}
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, meta=np.array(json.dumps(meta)),
+                 **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """读save存下来的索引，返回(index, 源文件的状态)"""
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('version') != INDEX_VERSION:
+                raise ValueError('index version mismatch')
+            arrays = {name: data[name] for name in cls.ARRAYS}
+        grid = UniformGrid(meta['bounds'], meta['cell_size'])
+        segment_grid = UniformGrid(meta['segment_bounds'], meta['segment_cell_size'])
+        return cls(grid, segment_grid, **arrays), meta['sources']
+
+    @property
+    def incidents(self):
+        if self._incidents is None:
+            self._incidents = pd.read_csv(self.csv_path)
+        return self._incidents
+
+    @property
+    def roads(self):
+        """路的属性表（.dbf），行号就是segment_road里的值"""
+        if self._roads is None:
+            self._roads = read_dbf(self.roads_path + '.dbf')
+        return self._roads
+
+    # 类别
+
+    def categories(self):
+        return DataFrame({'code': self.cat_codes, 'english': self.cat_names})
+
+    def category_frame(self):
+        """和书里的dummy_frame一样，每个类别一列，不过是稀疏的"""
+        rows, offsets = self._by_category()
+        columns = {}
+        for j, code in enumerate(self.cat_codes):
+            column = np.zeros(len(self.lon), dtype=np.int8)
+            column[rows[offsets[j]:offsets[j + 1]]] = 1
+            columns['category_' + code] = pd.arrays.SparseArray(column, fill_value=0)
+        return DataFrame(columns)
+
+    def _by_category(self):
+        """按类别转置过的索引：第j个类别的事件是rows[offsets[j]:offsets[j+1]]，第一次用时才建"""
+        if self._category_rows is None:
+            order, offsets = _group(self.cat_indices, len(self.cat_codes))
+            rows = np.repeat(np.arange(len(self.lon), dtype=np.int32), np.diff(self.cat_indptr))
+            self._category_rows = rows[order], offsets
+        return self._category_rows
+
+    def rows_with_category(self, code):
+        """有这个类别的事件行号"""
+        j = int(np.searchsorted(self.cat_codes, code))
+        if j == len(self.cat_codes) or self.cat_codes[j] != code:
+            raise KeyError(code)
+        rows, offsets = self._by_category()
+        return rows[offsets[j]:offsets[j + 1]]
+
+    def categories_of(self, row):
+        return self.cat_codes[self.cat_indices[self.cat_indptr[row]:self.cat_indptr[row + 1]]]
+
+    # 空间查询
+
+    def in_bbox(self, minx, miny, maxx, maxy):
+        """经纬度矩形里的事件行号"""
+        rows = self.grid.candidates(self.point_items, self.point_offsets, minx, miny, maxx, maxy)
+        lon, lat = self.lon[rows], self.lat[rows]
+        rows = rows[(lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)]
+        rows.sort()
+        return rows
+
+    def _degree_box(self, lon, lat, radius):
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        return lon - dlon, lat - dlat, lon + dlon, lat + dlat
+
+    def within(self, lon, lat, radius):
+        """离(lon, lat)不超过radius米的事件，返回(行号, 距离)，按距离从近到远"""
+        rows = self.in_bbox(*self._degree_box(lon, lat, radius))
+        distance = haversine(lon, lat, self.lon[rows], self.lat[rows])
+        keep = distance <= radius
+        rows, distance = rows[keep], distance[keep]
+        order = np.argsort(distance, kind='stable')
+        return rows[order], distance[order]
+
+    def nearest_road(self, lon, lat, max_distance=None):
+        """
+        离(lon, lat)最近的路段，返回(路段编号, 距离米)，max_distance以内没有时返回(-1, inf)。
+
+        从所在的格子开始往外找，每次把范围扩大一倍（0、1、2、4...圈），
+        找到的最近距离比还没看过的格子都近时就停下。
+        """
+        grid = self.segment_grid
+        # 一个格子的宽度换成米，取经度方向和纬度方向里小的那个
+        scale = math.radians(1) * EARTH_RADIUS * min(1.0, math.cos(math.radians(lat)))
+        cell_m = grid.cell_size * scale
+        # 网格外面的点也照样算格子，网格以外的格子都是空的
+        ix, iy = grid.cell_of(lon, lat)
+        x0, y0 = grid.bounds[0] + ix * grid.cell_size, grid.bounds[1] + iy * grid.cell_size
+        # 点到所在格子边界的最短距离，第k圈以外的路段至少隔着这么远再加k个格子
+        edge = min(lon - x0, x0 + grid.cell_size - lon, lat - y0, y0 + grid.cell_size - lat)
+        edge_m = max(edge, 0.0) * scale
+        best = (-1, math.inf)
+        # 从第一个碰到网格的圈开始
+        k = max(0, -ix, ix - (grid.nx - 1), -iy, iy - (grid.ny - 1))
+        while True:
+            if ix - k <= 0 and iy - k <= 0 and ix + k >= grid.nx - 1 and iy + k >= grid.ny - 1:
+                # 已经要覆盖整个网格了，不如直接把所有路段算一遍，省得有重复的
+                return self._closest(lon, lat, np.arange(len(self.segments)), max_distance)
+            candidates = grid.in_cells(self.segment_items, self.segment_offsets,
+                                       ix - k, ix + k, iy - k, iy + k)
+            if len(candidates):
+                # 一段路可能在好几个格子里，重复的不影响找最小值
+                best = self._closest(lon, lat, candidates, max_distance)
+            reach = edge_m + k * cell_m # 第k圈以外的路段至少有这么远
+            if best[0] >= 0 and best[1] <= reach:
+                return best
+            if max_distance is not None and reach >= max_distance:
+                return best
+            k = k * 2 or 1
+
+    def _closest(self, lon, lat, candidates, max_distance):
+        if not len(candidates):
+            return -1, math.inf
+        distance = _segment_distance(lon, lat, self.segments[candidates])
+        i = int(np.argmin(distance))
+        if max_distance is not None and distance[i] > max_distance:
+            return -1, math.inf
+        return int(candidates[i]), float(distance[i])
+
+    def road_incident_counts(self, max_distance=100.0):
+        """每条路（.dbf里的每一行）max_distance米以内最近的事件数，每个事件只算给离它最近的那条路"""
+        counts = np.zeros(int(self.segment_road.max()) + 1 if len(self.segment_road) else 0,
+                          dtype=np.int64)
+        for lon, lat in zip(self.lon, self.lat):
+            segment, _ = self.nearest_road(lon, lat, max_distance)
+            if segment >= 0:
+                counts[self.segment_road[segment]] += 1
+        return pd.Series(counts, name='incidents')
+
+
+def load(index_path=INDEX_PATH, csv_path=CSV_PATH, roads_path=ROADS_PATH, rebuild=False):
+    """
+    读存好的索引；没有、版本不对或者源文件变了的话重新建一个再存起来。
+    """
+    paths = [csv_path, roads_path + '.shp']
+    if not rebuild and os.path.exists(index_path):
+        try:
+            index, saved = HaitiIndex.load(index_path)
+        except (OSError, ValueError, KeyError):
+            index, saved = None, None
+        # 失效的规则和DatasetCache一样，都在cache.sources_fresh里
+        if index is not None and sources_fresh(saved, paths)[0]:
+            index.csv_path, index.roads_path = csv_path, roads_path
+            return index
+    index = HaitiIndex.build(csv_path, roads_path)
+    index.save(index_path, fingerprint_sources(paths))
+    return index
+
+
+if __name__ == '__main__':
+    haiti = load()
+    print(haiti.categories())
+    rows, distance = haiti.within(-72.335, 18.539, 500) # 太子港市中心附近500米
+    print(len(rows), distance[:5])
+    print(haiti.nearest_road(-72.335, 18.539))
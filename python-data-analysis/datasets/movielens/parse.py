@@ -0,0 +1,250 @@
+import csv
+import io
+import os
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from ..cache import default_cache
+
+# 书里用pd.read_table(path, sep='::', engine='python')，分隔符是两个字符，
+# pandas只能退回到很慢的Python解析器；类型是题材用|连起来的字符串，
+# 按题材筛选只能str.contains，评分、用户、电影三张表连起来要merge两次。
+# 这里把::换成一个单字节的分隔符再交给C解析器，按块读，ratings.dat到10M条也不会一次占太多内存；
+# id都是int32，题材是一个位掩码，再建好id到行号的索引，连表就是数组下标，按题材筛选就是位运算。
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PARSE_VERSION = 1 # 传给DatasetCache.load的version
+SEP = b'\x1f' # ASCII的单元分隔符，数据里不会出现
+
+# README里列出来的题材，顺序就是位掩码里的位；10M的数据还有IMAX等，遇到时往后加
+GENRES = ['Action', 'Adventure', 'Animation', "Children's", 'Comedy', 'Crime',
+          'Documentary', 'Drama', 'Fantasy', 'Film-Noir', 'Horror', 'Musical',
+          'Mystery', 'Romance', 'Sci-Fi', 'Thriller', 'War', 'Western']
+
+MOVIE_COLUMNS = ['movie_id', 'title', 'genres']
+USER_COLUMNS = ['user_id', 'gender', 'age', 'occupation', 'zip']
+RATING_COLUMNS = ['user_id', 'movie_id', 'rating', 'timestamp']
+
+MOVIE_DTYPES = {'movie_id': np.int32, 'title': object, 'genres': object}
+USER_DTYPES = {'user_id': np.int32, 'gender': object, 'age': np.int8,
+               'occupation': np.int8, 'zip': object}
+# 1M的评分都是整数星，10M的有半星，所以用float32
+RATING_DTYPES = {'user_id': np.int32, 'movie_id': np.int32, 'rating': np.float32,
+                 'timestamp': np.int32}
+
+
+def _parse_block(block, names, dtypes, encoding):
+    frame = pd.read_csv(io.BytesIO(block.replace(b'::', SEP)), sep=SEP.decode(), header=None,
+                        names=names, dtype=dtypes, encoding=encoding,
+                        quoting=csv.QUOTE_NONE, na_filter=False, engine='c')
+    return {name: frame[name].to_numpy() for name in names}
+
+
+def read_dat(path, names, dtypes, encoding='latin-1', chunk_bytes=16 << 20):
+    """
+    读一个::分隔的文件，返回{列名: numpy数组}。
+
+    文件按chunk_bytes分块读，每块在最后一个换行处截断，剩下的半行留给下一块。
+    """
+    parts = []
+    rest = b''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            block, rest = block[:cut], block[cut:]
+            if block:
+                parts.append(_parse_block(block, names, dtypes, encoding))
+    if rest.strip():
+        parts.append(_parse_block(rest, names, dtypes, encoding))
+    if not parts:
+        return {name: np.empty(0, dtype=dtypes[name]) for name in names}
+    return {name: np.concatenate([part[name] for part in parts]) for name in names}
+
+
+def genre_masks(genres, known=GENRES):
+    """
+    把'Animation|Children's|Comedy'这样的字符串变成位掩码，返回(uint32数组, 题材列表)。
+
+    不同的组合只有几百种，先factorize，每种组合只拆一次。
+    """
+    known = list(known)
+    codes, combos = pd.factorize(genres)
+    combo_masks = np.zeros(len(combos), dtype=np.uint32)
+    for i, combo in enumerate(combos):
+        for genre in combo.split('|'):
+            if not genre:
+                continue
+            if genre not in known:
+                if len(known) == 32:
+                    raise ValueError('too many genres for a uint32 mask: %r' % genre)
+                known.append(genre)
+            combo_masks[i] |= np.uint32(1 << known.index(genre))
+    return combo_masks[codes], known
+
+
+def _id_index(ids):
+    """id到行号的稠密索引，不存在的id是-1"""
+    index = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int32)
+    index[ids] = np.arange(len(ids), dtype=np.int32)
+    return index
+
+
+def _group_index(keys, size):
+    """按keys分组的行号：第k组是order[offsets[k]:offsets[k+1]]"""
+    order = np.argsort(keys, kind='stable').astype(np.int32)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=size), out=offsets[1:])
+    return order, offsets
+
+
+class MovieLens(object):
+    """
+    movies、users、ratings三张表和预先建好的索引。
+
+    movies的genres列是位掩码，题材的顺序在self.genres里。
+    movie_row[movie_id]、user_row[user_id]是id到行号的索引，找不到是-1；
+    ratings里已经存了每条评分对应的movie_row和user_row，按电影或者用户找评分也有索引。
+    """
+
+    def __init__(self, movies, users, ratings=None, genres=GENRES):
+        self.movies = movies
+        self.users = users
+        self.genres = list(genres)
+        self.movie_row = _id_index(movies['movie_id'].to_numpy())
+        self.user_row = _id_index(users['user_id'].to_numpy())
+        self.ratings = None
+        if ratings is not None:
+            self.set_ratings(ratings)
+
+    def set_ratings(self, ratings):
+        self.ratings = ratings
+        self.rating_movie_row = self._lookup(self.movie_row, ratings['movie_id'].to_numpy())
+        self.rating_user_row = self._lookup(self.user_row, ratings['user_id'].to_numpy())
+        self._by_movie = _group_index(np.where(self.rating_movie_row < 0, len(self.movies),
+                                               self.rating_movie_row), len(self.movies) + 1)
+        self._by_user = _group_index(np.where(self.rating_user_row < 0, len(self.users),
+                                              self.rating_user_row), len(self.users) + 1)
+
+    @staticmethod
+    def _lookup(index, ids):
+        rows = np.full(len(ids), -1, dtype=np.int32)
+        valid = (ids >= 0) & (ids < len(index))
+        rows[valid] = index[ids[valid]]
+        return rows
+
+    def genre_mask(self, *genres):
+        mask = 0
+        for genre in genres:
+            mask |= 1 << self.genres.index(genre)
+        return np.uint32(mask)
+
+    def movies_with_genres(self, *genres, match='any'):
+        """有这些题材的电影，match='all'时要全部都有"""
+        mask = self.genre_mask(*genres)
+        bits = self.movies['genres'].to_numpy() & mask
+        selected = bits == mask if match == 'all' else bits != 0
+        return self.movies[selected]
+
+    def genre_names(self, mask):
+        return [genre for i, genre in enumerate(self.genres) if int(mask) >> i & 1]
+
+    @staticmethod
+    def _row(index, id_):
+        row = index[id_] if 0 <= id_ < len(index) else -1
+        if row < 0:
+            raise KeyError(id_)
+        return row
+
+    def ratings_of_movie(self, movie_id):
+        order, offsets = self._by_movie
+        row = self._row(self.movie_row, movie_id)
+        return self.ratings.iloc[order[offsets[row]:offsets[row + 1]]]
+
+    def ratings_of_user(self, user_id):
+        order, offsets = self._by_user
+        row = self._row(self.user_row, user_id)
+        return self.ratings.iloc[order[offsets[row]:offsets[row + 1]]]
+
+    def joined(self, user_columns=('gender', 'age', 'occupation'), movie_columns=('title', 'genres')):
+        """
+        评分加上用户和电影的列，相当于书里的pd.merge(pd.merge(ratings, users), movies)。
+
+        只是按行号取数组，不用merge；找不到用户或者电影的评分会被去掉，和merge一样。
+        """
+        keep = (self.rating_user_row >= 0) & (self.rating_movie_row >= 0)
+        data = {name: self.ratings[name].to_numpy()[keep] for name in self.ratings.columns}
+        user_rows = self.rating_user_row[keep]
+        movie_rows = self.rating_movie_row[keep]
+        # 用.array.take，category这样的类型不会丢
+        for name in user_columns:
+            data[name] = self.users[name].array.take(user_rows)
+        for name in movie_columns:
+            data[name] = self.movies[name].array.take(movie_rows)
+        return DataFrame(data)
+
+
+def load_movies(path=os.path.join(HERE, 'movies.dat'), chunk_bytes=16 << 20):
+    columns = read_dat(path, MOVIE_COLUMNS, MOVIE_DTYPES, chunk_bytes=chunk_bytes)
+    columns['genres'], genres = genre_masks(columns['genres'])
+    return DataFrame(columns, columns=MOVIE_COLUMNS), genres
+
+
+def load_users(path=os.path.join(HERE, 'users.dat'), chunk_bytes=16 << 20):
+    columns = read_dat(path, USER_COLUMNS, USER_DTYPES, chunk_bytes=chunk_bytes)
+    columns['gender'] = pd.Categorical(columns['gender'], categories=['F', 'M'])
+    return DataFrame(columns, columns=USER_COLUMNS)
+
+
+def load_ratings(path=os.path.join(HERE, 'ratings.dat'), chunk_bytes=16 << 20):
+    return DataFrame(read_dat(path, RATING_COLUMNS, RATING_DTYPES, chunk_bytes=chunk_bytes),
+                     columns=RATING_COLUMNS)
+
+
+def load(directory=HERE, ratings=None):
+    """
+    读movies.dat、users.dat，ratings.dat存在的话也一起读。
+
+    ratings可以直接给一个评分文件的路径，比如10M数据里的ratings.dat。
+    """
+    movies, genres = load_movies(os.path.join(directory, 'movies.dat'))
+    users = load_users(os.path.join(directory, 'users.dat'))
+    if ratings is None and os.path.exists(os.path.join(directory, 'ratings.dat')):
+        ratings = os.path.join(directory, 'ratings.dat')
+    return MovieLens(movies, users, load_ratings(ratings) if ratings else None, genres)
+
+
+def load_cached(directory=HERE, ratings=None, cache=default_cache):
+    """和load一样，每张表分别缓存到磁盘上，下次直接mmap读回来再建索引"""
+    movies_path = os.path.join(directory, 'movies.dat')
+    parsed = {}
+
+    def parse_movies():
+        parsed['movies'], parsed['genres'] = load_movies(movies_path)
+        return parsed['movies']
+    movies = cache.load('movielens-movies', [movies_path], parse_movies, version=PARSE_VERSION)
+    # 位掩码里每一位是哪个题材也要存下来，10M的数据里有README以外的题材
+    genres = cache.load('movielens-genres', [movies_path],
+                        lambda: DataFrame({'genre': parsed['genres'] if parsed else
+                                           load_movies(movies_path)[1]}),
+                        version=PARSE_VERSION)['genre'].tolist()
+    users_path = os.path.join(directory, 'users.dat')
+    users = cache.load('movielens-users', [users_path],
+                       lambda: load_users(users_path), version=PARSE_VERSION)
+    if ratings is None and os.path.exists(os.path.join(directory, 'ratings.dat')):
+        ratings = os.path.join(directory, 'ratings.dat')
+    if ratings:
+        ratings = cache.load('movielens-ratings', [ratings],
+                             lambda: load_ratings(ratings), version=PARSE_VERSION)
+    return MovieLens(movies, users, ratings, genres)
+
+
+if __name__ == '__main__':
+    movielens = load_cached()
+    print(movielens.movies_with_genres('Animation', "Children's", match='all').head())
+    print(movielens.users.groupby('gender', observed=True).size())
@@ -1,16 +1,138 @@
+import array
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
 from pandas import DataFrame
-from lxml import objectify
+from pandas.api.types import union_categoricals
+from lxml import etree
+
+from ..cache import default_cache
+
+# 原来的写法是objectify.parse把整棵树读进内存，再给每一行建一个dict，最后交给DataFrame，
+# 而且只读了MNR这一个文件。这里用iterparse边读边处理：每读完一个INDICATOR就把值追加到
+# 按列存放的数组里，然后把这个元素清掉，内存不会随文件变大而增长；
+# 六个文件可以分到多个进程里同时解析，最后拼成一个DataFrame，用source列区分来源。
+
+FEEDS = ['LIBUS', 'LIRR', 'MNR', 'MTABUS', 'NYCT', 'TBTA']
+
+# 每一列的类型，字符串列都做字典编码，最后变成category
+INT_FIELDS = ['INDICATOR_SEQ', 'PERIOD_YEAR', 'PERIOD_MONTH', 'DECIMAL_PLACES']
+FLOAT_FIELDS = ['PARENT_SEQ', 'YTD_TARGET', 'YTD_ACTUAL', 'MONTHLY_TARGET', 'MONTHLY_ACTUAL'] # 有空值
+STRING_FIELDS = ['AGENCY_NAME', 'INDICATOR_NAME', 'DESCRIPTION', 'CATEGORY',
+                 'FREQUENCY', 'DESIRED_CHANGE', 'INDICATOR_UNIT']
+COLUMNS = ['INDICATOR_SEQ', 'PARENT_SEQ', 'AGENCY_NAME', 'INDICATOR_NAME', 'DESCRIPTION',
+           'PERIOD_YEAR', 'PERIOD_MONTH', 'CATEGORY', 'FREQUENCY', 'DESIRED_CHANGE',
+           'INDICATOR_UNIT', 'DECIMAL_PLACES', 'YTD_TARGET', 'YTD_ACTUAL',
+           'MONTHLY_TARGET', 'MONTHLY_ACTUAL']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PARSE_VERSION = 1 # 传给DatasetCache.load的version
+
+
+def feed_path(feed, directory=HERE):
+    return os.path.join(directory, 'Performance_%s.xml' % feed)
+
+
+def _to_float(text):
+    # 有些数字带千分位，比如1,047,961,000.00
+    if not text:
+        return np.nan
+    return float(text.replace(',', ''))
+
+
+def parse_feed(path):
+    """
+    解析一个Performance_*.xml，返回{列名: 数组}。
+
+    数字列是array.array，字符串列是(编码数组, 取值列表)，可以直接pickle回主进程。
+    """
+    ints = {name: array.array('q') for name in INT_FIELDS}
+    floats = {name: array.array('d') for name in FLOAT_FIELDS}
+    codes = {name: array.array('i') for name in STRING_FIELDS}
+    pools = {name: {} for name in STRING_FIELDS} # 字符串 -> 编码
+
+    for _, elt in etree.iterparse(path, events=('end',), tag='INDICATOR'):
+        row = {child.tag: child.text for child in elt}
+        for name, column in ints.items():
+            column.append(int(row.get(name) or 0))
+        for name, column in floats.items():
+            column.append(_to_float(row.get(name)))
+        for name, column in codes.items():
+            pool = pools[name]
+            text = row.get(name) or ''
+            code = pool.get(text)
+            if code is None:
+                code = pool[text] = len(pool)
+            column.append(code)
+        # 清掉已经处理过的元素，不然整棵树还是会留在内存里
+        elt.clear()
+        while elt.getprevious() is not None:
+            del elt.getparent()[0]
+
+    columns = {}
+    columns.update(ints)
+    columns.update(floats)
+    for name in STRING_FIELDS:
+        columns[name] = (codes[name], list(pools[name]))
+    return columns
+
+
+def _to_frame(columns):
+    data = {}
+    for name in COLUMNS:
+        column = columns[name]
+        if name in STRING_FIELDS:
+            codes, categories = column
+            data[name] = pd.Categorical.from_codes(np.frombuffer(codes, dtype=np.int32), categories)
+        elif name in INT_FIELDS:
+            data[name] = np.frombuffer(column, dtype=np.int64)
+        else:
+            data[name] = np.frombuffer(column, dtype=np.float64)
+    return DataFrame(data, columns=COLUMNS)
+
+
+def load_feed(feed, directory=HERE):
+    frame = _to_frame(parse_feed(feed_path(feed, directory)))
+    frame['source'] = pd.Categorical([feed] * len(frame), categories=[feed])
+    return frame
+
+
+def load_all(feeds=FEEDS, directory=HERE, processes=None):
+    """
+    解析所有的feed，拼成一个DataFrame。
+
+    processes大于1时每个文件一个任务，放到进程池里解析。
+    """
+    paths = [feed_path(feed, directory) for feed in feeds]
+    if processes is not None and processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            parsed = list(executor.map(parse_feed, paths))
+    else:
+        parsed = [parse_feed(path) for path in paths]
+
+    frames = [_to_frame(columns) for columns in parsed]
+    data = {}
+    for name in COLUMNS:
+        if name in STRING_FIELDS:
+            # 每个文件的取值不一样，直接concat会退化成object，先合并取值
+            data[name] = union_categoricals([frame[name] for frame in frames])
+        else:
+            data[name] = np.concatenate([frame[name].to_numpy() for frame in frames])
+    lengths = [len(frame) for frame in frames]
+    data['source'] = pd.Categorical.from_codes(
+        np.repeat(np.arange(len(feeds), dtype=np.int32), lengths), list(feeds))
+    return DataFrame(data, columns=COLUMNS + ['source'])
 
-path = 'Performance_MNR.xml'
-parsed = objectify.parse(open(path))
-root = parsed.getroot()
 
-data = []
+def load_all_cached(feeds=FEEDS, directory=HERE, processes=None, cache=default_cache):
+    """和load_all一样，但是解析结果会缓存到磁盘上，XML没变的话下次直接mmap读回来"""
+    paths = [feed_path(feed, directory) for feed in feeds]
+    return cache.load('mta_perf', paths, lambda: load_all(feeds, directory, processes),
+                      version=PARSE_VERSION)
 
-for elt in root.INDICATOR:
-    el_data = {}
-    for child in elt.getchildren():
-        el_data[child.tag] = child.pyval
-    data.append(el_data)
 
-perf = DataFrame(data)
+if __name__ == '__main__':
+    perf = load_all_cached(processes=len(FEEDS))
+    print(perf.groupby('source', observed=True).size())
@@ -1,5 +1,8 @@
+import sys
+
 import numpy as np
 from numpy.linalg import eigvals
+from concurrent.futures import ProcessPoolExecutor
 
 def run_experiment(niter=100):
     K = 100
@@ -9,5 +12,47 @@ def run_experiment(niter=100):
         max_eigenvalue = np.abs(eigvals(mat)).max()
         results.append(max_eigenvalue)
     return results
-some_results = run_experiment()
-print('Largest one we saw: %s' % np.max(some_results))
+
+# 批量版本：一次生成一摞(n, K, K)的矩阵，eigvals可以直接对整摞矩阵求特征值，
+# 省掉了Python循环；矩阵按块生成，每块不超过max_bytes，所以niter再大内存也不会爆。
+# 每一块用SeedSequence.spawn出来的独立随机数流，分块只和niter、K、max_bytes有关，
+# 所以同一个seed不管用几个进程，结果都完全一样。
+
+def _chunk_sizes(niter, K, max_bytes):
+    # eigvals内部还要拷贝一份，按两倍的矩阵大小估算
+    per_matrix = K * K * 8 * 2
+    chunk = max(1, min(niter, max_bytes // per_matrix))
+    sizes = [chunk] * (niter // chunk)
+    if niter % chunk:
+        sizes.append(niter % chunk)
+    return sizes
+
+def _run_chunk(n, K, seed_seq):
+    rng = np.random.default_rng(seed_seq)
+    mats = rng.standard_normal((n, K, K))
+    return np.abs(eigvals(mats)).max(axis=1)
+
+def run_experiment_batched(niter=100, K=100, seed=None, max_bytes=64 << 20, processes=None):
+    sizes = _chunk_sizes(niter, K, max_bytes)
+    if not sizes:
+        return np.empty(0)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if processes is not None and processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            parts = list(executor.map(_run_chunk, sizes, [K] * len(sizes), seeds))
+    else:
+        parts = [_run_chunk(n, K, s) for n, s in zip(sizes, seeds)]
+    return np.concatenate(parts)
+
+if __name__ == '__main__':
+    some_results = run_experiment()
+    print('Largest one we saw: %s' % np.max(some_results))
+
+    batched_results = run_experiment_batched(1000, seed=12345, max_bytes=8 << 20)
+    print('Largest one we saw (batched): %s' % batched_results.max())
+
+    # 进程池里的时间cProfile看不到，只会多出一堆等待和进程间通信，
+    # 所以用%run -p或者python -m cProfile分析这个脚本时不跑并行版本，要看并行的效果加--parallel
+    if '--parallel' in sys.argv:
+        parallel_results = run_experiment_batched(1000, seed=12345, max_bytes=8 << 20, processes=4)
+        print('Same results in parallel: %s' % np.array_equal(parallel_results, batched_results))
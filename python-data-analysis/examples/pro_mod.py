@@ -1,3 +1,9 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from numpy.random import randn
 
 def add_and_sum(x, y):
@@ -9,3 +15,48 @@ def call_function():
     x = randn(1000, 1000)
     y = randn(1000, 1000)
     return add_and_sum(x, y)
+
+# 分块版本：add_and_sum会先生成一个和x一样大的临时数组x + y，内存翻倍，
+# 而且x、y比内存还大的时候就没法算了。这里按行分块，每块的x + y写到事先分配好的缓冲区里，
+# 峰值内存只有几块的大小。x、y可以是np.memmap，只有用到的那几行会被读进内存。
+# NumPy做加法和求和时会释放GIL，所以可以用线程池同时算好几块。
+
+def add_and_sum_blocked(x, y, block_rows=256, out=None, threads=None):
+    n_rows, n_cols = x.shape
+    dtype = np.result_type(x, y)
+    if out is None:
+        out = np.empty(n_rows, dtype=dtype)
+    local = threading.local()
+
+    def work(start):
+        # 每个线程一块自己的缓冲区，反复使用
+        buf = getattr(local, 'buf', None)
+        if buf is None:
+            buf = local.buf = np.empty((block_rows, n_cols), dtype=dtype)
+        stop = min(start + block_rows, n_rows)
+        block = buf[:stop - start]
+        np.add(x[start:stop], y[start:stop], out=block)
+        block.sum(axis=1, out=out[start:stop])
+
+    starts = range(0, n_rows, block_rows)
+    if threads is not None and threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(work, starts))
+    else:
+        for start in starts:
+            work(start)
+    return out
+
+def call_function_blocked(n=1000, block_rows=256):
+    # 用磁盘上的memmap代替内存里的数组，数据再大也只需要几块的内存。
+    # 填数据也按块来，不然randn(n, n)本身就是一整个数组在内存里；文件放在临时目录，用完删掉
+    with tempfile.TemporaryDirectory() as directory:
+        xy = np.memmap(os.path.join(directory, 'xy.dat'), dtype='float64', mode='w+',
+                       shape=(2, n, n))
+        for start in range(0, n, block_rows):
+            stop = min(start + block_rows, n)
+            xy[0, start:stop] = randn(stop - start, n)
+            xy[1, start:stop] = randn(stop - start, n)
+        summed = add_and_sum_blocked(xy[0], xy[1], block_rows, threads=4)
+        del xy # 先关掉memmap再删文件
+    return summed
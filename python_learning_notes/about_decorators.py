@@ -1,3 +1,19 @@
+import array
+import asyncio
+import collections
+import fcntl
+import hashlib
+import inspect
+import itertools
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import weakref
+import zlib
+
 # 装饰器就是高阶函数的语法糖，也可以叫做闭包
 def my_shiny_new_decorator(a_function_to_decorate):
 
@@ -269,18 +285,173 @@ print(foo.__name__)
 #outputs: foo
 
 # 装饰器的一些应用，可以不断添加
-def benchmark(func):
+# 计时：time.clock()在Python 3.8里已经删掉了，而且每次调用都print，放在热点函数上根本没法用。
+# 这里把耗时记到一个固定大小的直方图里，需要的时候再统一看p50/p99/max。
+
+
+class LatencyHistogram(object):
     """
-    A decorator that prints the time a function takes
-    to execute
+    固定内存的对数分桶直方图，思路和HDR Histogram一样。
+
+    每个2的幂次区间再等分成16个小桶，所以任何值的相对误差都不超过1/16；
+    桶的个数是固定的，记多少次内存都不会变。单位是纳秒。
     """
-    import time
-    def wrapper(*args, **kwargs):
-        t = time.clock()
-        res = func(*args, **kwargs)
-        print("{0} {1}".format(func.__name__, time.clock()-t))
-        return res
-    return wrapper
+
+    SUB_BITS = 4
+    SUB_COUNT = 1 << SUB_BITS # 每个2的幂次区间分成16个小桶
+    LINEAR = 2 * SUB_COUNT # 小于这个数的值每个值一个桶
+    BUCKETS = 656 # 最大能区分到2**44纳秒（大约5个小时），再大的都算在最后一个桶里
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = array.array('Q', [0]) * self.BUCKETS
+            self.count = 0
+            self.total = 0
+            self.max = 0
+
+    @classmethod
+    def _index(cls, ns):
+        if ns < cls.LINEAR:
+            return ns
+        shift = ns.bit_length() - cls.SUB_BITS - 1
+        index = ((shift + 1) << cls.SUB_BITS) + (ns >> shift) - cls.SUB_COUNT
+        return min(index, cls.BUCKETS - 1)
+
+    @classmethod
+    def _upper(cls, index):
+        """第index个桶里最大的值"""
+        if index < cls.LINEAR:
+            return index
+        shift = (index >> cls.SUB_BITS) - 1
+        top = (index & (cls.SUB_COUNT - 1)) + cls.SUB_COUNT
+        return ((top + 1) << shift) - 1
+
+    def record(self, ns):
+        # 和_index一样，展开写是因为这里在被计时函数的调用路径上
+        if ns < self.LINEAR:
+            index = ns
+        else:
+            shift = ns.bit_length() - self.SUB_BITS - 1
+            index = ((shift + 1) << self.SUB_BITS) + (ns >> shift) - self.SUB_COUNT
+            if index >= self.BUCKETS:
+                index = self.BUCKETS - 1
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += ns
+            if ns > self.max:
+                self.max = ns
+
+    def percentile(self, p):
+        """第p百分位数（0到100），返回所在桶的上界，不会超过实际的最大值"""
+        with self._lock:
+            if not self.count:
+                return 0
+            target = max(1, -(-self.count * p // 100)) # 向上取整
+            seen = 0
+            for index, n in enumerate(self.counts):
+                seen += n
+                if seen >= target:
+                    return min(self._upper(index), self.max)
+            return self.max
+
+    def summary(self):
+        """以微秒为单位的统计"""
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count / 1e3 if self.count else 0.0,
+            'p50_us': self.percentile(50) / 1e3,
+            'p99_us': self.percentile(99) / 1e3,
+            'max_us': self.max / 1e3,
+        }
+
+
+class TimingRegistry(object):
+    """所有被计时函数的直方图，按名字存放"""
+
+    def __init__(self):
+        self.enabled = True # 总开关，关掉以后再装饰的函数不会被包装
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = LatencyHistogram()
+            return hist
+
+    def dump(self):
+        """{函数名: {count, mean_us, p50_us, p99_us, max_us}}"""
+        with self._lock:
+            items = list(self._histograms.items())
+        return {name: hist.summary() for name, hist in items}
+
+    def report(self):
+        for name, s in sorted(self.dump().items()):
+            print("{0:40} n={1:<8} p50={2:.1f}us p99={3:.1f}us max={4:.1f}us".format(
+                name, s['count'], s['p50_us'], s['p99_us'], s['max_us']))
+
+    def reset(self):
+        with self._lock:
+            for hist in self._histograms.values():
+                hist.reset()
+
+
+timings = TimingRegistry()
+
+
+def benchmark(func=None, sample_rate=1.0, name=None, registry=timings):
+    """
+    A decorator that records the time a function takes
+    to execute into a latency histogram
+
+    sample_rate小于1时只对一部分调用计时，比如0.01就是每100次记一次，为0时不计时。
+    registry.enabled为False时直接返回原函数，没有任何额外开销，
+    所以要在导入被装饰的模块之前关掉，比如 timings.enabled = False。
+    """
+    if not 0 <= sample_rate <= 1:
+        raise ValueError('sample_rate must be between 0 and 1, got %r' % (sample_rate,))
+
+    def decorator(func):
+        if not registry.enabled or sample_rate == 0:
+            return func
+        hist = registry.histogram(name or func.__qualname__)
+        record = hist.record
+        perf_counter_ns = time.perf_counter_ns
+
+        if sample_rate >= 1:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    record(perf_counter_ns() - start)
+            return wrapper
+
+        # 按固定间隔采样，比每次调用random.random()便宜
+        every = max(1, round(1 / sample_rate))
+        calls = itertools.count()
+
+        @functools.wraps(func)
+        def sampled_wrapper(*args, **kwargs):
+            if next(calls) % every:
+                return func(*args, **kwargs)
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(perf_counter_ns() - start)
+        return sampled_wrapper
+
+    if func is None:
+        return decorator
+    return decorator(func)
 
 def logging(func):
     """
@@ -293,17 +464,114 @@ def logging(func):
         return res
     return wrapper
 
-def counter(func):
+# 计数：wrapper.count = wrapper.count + 1不是原子操作，多线程下会丢计数，
+# 原来的版本还把返回值弄丢了，并且每次调用都要print。
+class CallCounter(object):
+    """
+    分片计数器。
+
+    每个线程只改自己的那一格，调用路径上不加锁也不会丢计数；
+    读的时候再把所有格子加起来，已经结束的线程的格子会合并掉，不会越攒越多。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = [] # [(线程, [计数])]
+        self._retired = 0 # 已经结束的线程的计数
+        self._offset = 0 # reset时的总数，读数时减掉
+        self._lock = threading.Lock() # 只在线程第一次计数、读数和重置时用
+
+    def cell(self):
+        """当前线程的格子，第一次调用时创建"""
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0]
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+            return cell
+
+    def increment(self, n=1):
+        self.cell()[0] += n
+
+    def _total(self):
+        alive = []
+        for thread, cell in self._cells:
+            if thread.is_alive():
+                alive.append((thread, cell))
+            else:
+                self._retired += cell[0] # 线程结束了，不会再有人改这一格
+        self._cells = alive
+        return self._retired + sum(cell[0] for _, cell in alive)
+
+    def value(self):
+        with self._lock:
+            return self._total() - self._offset
+
+    def reset(self):
+        """清零，返回清零之前的值"""
+        with self._lock:
+            total = self._total()
+            value, self._offset = total - self._offset, total
+            return value
+
+
+class CounterRegistry(object):
+    """所有计数器，按名字存放，方便统一导出"""
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = CallCounter()
+            return counter
+
+    def snapshot(self):
+        """{函数名: 调用次数}"""
+        with self._lock:
+            items = list(self._counters.items())
+        return {name: counter.value() for name, counter in items}
+
+    def reset(self):
+        """全部清零，返回清零之前的快照"""
+        with self._lock:
+            items = list(self._counters.items())
+        return {name: counter.reset() for name, counter in items}
+
+
+counters = CounterRegistry()
+
+
+def counter(func=None, name=None, registry=counters):
     """
-    A decorator that counts and prints the number of times a function has been executed
+    A decorator that counts the number of times a function has been executed
+
+    调用路径上只有一次线程局部变量的读取和一次加法，没有锁也没有I/O；
+    次数通过wrapper.counter.value()或者counters.snapshot()来读。
     """
-    def wrapper(*args, **kwargs):
-        wrapper.count = wrapper.count + 1
-        res = func(*args, **kwargs)
-        print("{0} has been used: {1}x".format(func.__name__, wrapper.count))
-    # 为函数添加属性
-    wrapper.count = 0
-    return wrapper
+    def decorator(func):
+        call_counter = registry.counter(name or func.__qualname__)
+        local = call_counter._local
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                cell = local.cell
+            except AttributeError:
+                cell = call_counter.cell()
+            cell[0] += 1
+            return func(*args, **kwargs)
+        # 为函数添加属性
+        wrapper.counter = call_counter
+        return wrapper
+
+    if func is None:
+        return decorator
+    return decorator(func)
 
 @counter
 @benchmark
@@ -317,30 +585,689 @@ def reverse_string(string):
 
 # 一个使用装饰器做缓存的例子
 # 存储函数的返回值，如果下次调用的参数一样，那么久不需要再次调用，直接返回结果就好
+# 最早的版本只是用一个字典存结果，放到长期运行的服务里会有几个问题：
+# 字典只增不减，内存会一直涨；多线程同时读写没有加锁；list、dict这种参数直接不缓存；
+# 装饰方法时所有实例共用一个缓存。下面这个版本把这些问题都处理掉了。
+
+_MISSING = object() # 缓存里没有时返回的哨兵，因为None也可能是正常的返回值
+
+
+def _freeze(value):
+    """把list、dict、set这种不能哈希的参数递归地转成可以哈希的tuple"""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        pass
+    if isinstance(value, dict):
+        items = ((_freeze(k), _freeze(v)) for k, v in value.items())
+        # 按repr排序，这样key的插入顺序不同也能得到同一个结果
+        return (dict, tuple(sorted(items, key=repr)))
+    if isinstance(value, (set, frozenset)):
+        return (set, frozenset(_freeze(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(v) for v in value))
+    raise TypeError('unhashable argument: %r' % type(value).__name__)
+
+
+def make_key(args, kwargs):
+    """默认的key函数，参数里有不能哈希又不认识的类型时抛TypeError，这次调用就不缓存"""
+    if not kwargs:
+        if len(args) == 1 and type(args[0]) in (int, str):
+            return args[0] # 最常见的单个参数，省掉建tuple
+        return _freeze(args)
+    return (_freeze(args), _freeze(kwargs))
+
+
+class _LRUStore(object):
+    """淘汰最久没有用过的"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = collections.OrderedDict() # key -> (过期时间, 值)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        """返回(值, 是否过期)，没有时值是_MISSING"""
+        item = self.data.get(key)
+        if item is None:
+            return _MISSING, False
+        expires, value = item
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            return _MISSING, True
+        self.data.move_to_end(key)
+        return value, False
+
+    def set(self, key, value):
+        """放进去，返回因为满了被淘汰掉的个数"""
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.data[key] = (expires, value)
+        self.data.move_to_end(key)
+        evicted = 0
+        while self.maxsize is not None and len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def clear(self):
+        self.data.clear()
+
+
+class _LFUStore(object):
+    """
+    淘汰用得最少的，次数一样时淘汰其中最久没用的。
+
+    按使用次数分桶，每个桶是一个OrderedDict，再记下最小的次数，取和放都是O(1)。
+    """
 
-class memoized(object):
-    def __init__(self, func):
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = {} # key -> [过期时间, 值, 次数]
+        self.buckets = collections.defaultdict(collections.OrderedDict) # 次数 -> {key: None}
+        self.min_freq = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def _touch(self, key, item):
+        freq = item[2]
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[freq]
+            if self.min_freq == freq:
+                self.min_freq = freq + 1
+        item[2] = freq + 1
+        self.buckets[freq + 1][key] = None
+
+    def _remove(self, key):
+        item = self.data.pop(key)
+        bucket = self.buckets[item[2]]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[item[2]]
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return _MISSING, False
+        if item[0] is not None and item[0] < time.monotonic():
+            self._remove(key)
+            return _MISSING, True
+        self._touch(key, item)
+        return item[1], False
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        item = self.data.get(key)
+        if item is not None:
+            item[0] = expires
+            item[1] = value
+            self._touch(key, item)
+            return 0
+        evicted = 0
+        if self.maxsize is not None and len(self.data) >= self.maxsize:
+            if self.maxsize <= 0:
+                return 0
+            # 最小次数的桶里，最早放进去的那个
+            victim = next(iter(self.buckets[self.min_freq]))
+            self._remove(victim)
+            evicted = 1
+        self.data[key] = [expires, value, 1]
+        self.buckets[1][key] = None
+        self.min_freq = 1
+        return evicted
+
+    def clear(self):
+        self.data.clear()
+        self.buckets.clear()
+        self.min_freq = 0
+
+
+_POLICIES = {'lru': _LRUStore, 'lfu': _LFUStore}
+
+
+class Memoized(object):
+    """
+    memoized装饰器返回的对象。
+
+    缓存的读写加了锁，但是被装饰的函数在锁外面执行，所以递归调用（比如fibonacci）不会死锁。
+    装饰方法时每个实例有自己的缓存，实例被回收时缓存也一起回收。
+    """
+
+    def __init__(self, func, maxsize=128, policy='lru', ttl=None, key=make_key):
+        if policy not in _POLICIES:
+            raise ValueError('unknown cache policy: %r' % policy)
         self.func = func
-        self.cache = {}
-    def __call__(self, *args):
-        # 如果无法哈希，例如list这种，就运行函数
-        if not isinstance(args, collections.Hashable):
-            return self.func(*args)
-        if args in self.cache:
-            return self.cache[args]
-        else:
-            value = self.func(*args)
-            self.cache[args] = value
-            return value
+        self.maxsize = maxsize
+        self.policy = policy
+        self.ttl = ttl
+        self.key = key
+        self._store = _POLICIES[policy](maxsize, ttl)
+        self._lock = threading.Lock()
+        self._instances = {} # 没有__dict__的实例，缓存放在这里，id(实例) -> 绑定好的Memoized
+        self._name = None
+        self.hits = self.misses = self.evictions = self.expirations = self.uncacheable = 0
+        functools.update_wrapper(self, func)
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key = self.key(args, kwargs)
+        except TypeError:
+            # 参数实在没法做成key，只能直接调用
+            self.uncacheable += 1
+            return self.func(*args, **kwargs)
+        with self._lock:
+            value, expired = self._store.get(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            self.expirations += expired
+        value = self.func(*args, **kwargs)
+        with self._lock:
+            self.evictions += self._store.set(key, value)
+        return value
+
     def __repr__(self):
-        return self.func.__doc.__
-    def __get__(self, obj, objtype):
-        return functools.partial(self.__call__, obj)
+        return '<memoized %s>' % getattr(self.func, '__qualname__', self.func)
+
+    def __set_name__(self, owner, name):
+        self._name = name
+
+    def _bind(self, obj):
+        """
+        给实例obj新建一个缓存，func绑定到obj上。
+
+        绑定时只拿obj的弱引用，调用时再取出来，这样缓存不会让obj一直活着。
+        """
+        try:
+            ref = weakref.ref(obj)
+        except TypeError:
+            # 不能弱引用的话只有放进obj自己的__dict__这一种情况，是一个gc能回收的循环引用
+            method = functools.partial(self.func, obj)
+        else:
+            func = self.func
+
+            def method(*args, **kwargs):
+                return func(ref(), *args, **kwargs)
+        bound = type(self)(method, self.maxsize, self.policy, self.ttl, self.key)
+        functools.update_wrapper(bound, self.func)
+        return bound
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        # 和functools.cached_property一样，放到实例的__dict__里，下次直接从实例上拿到，
+        # 不会再走这里。
+        if self._name is not None and hasattr(obj, '__dict__'):
+            bound = obj.__dict__.get(self._name)
+            if bound is None:
+                bound = obj.__dict__[self._name] = self._bind(obj)
+            return bound
+        # 用id做key，实例不需要能哈希；实例被回收时finalize把它的缓存删掉，
+        # 这发生在id被别的对象复用之前
+        key = id(obj)
+        with self._lock:
+            bound = self._instances.get(key)
+            if bound is None:
+                try:
+                    weakref.finalize(obj, self._instances.pop, key, None)
+                except TypeError:
+                    # 既没有__dict__也不能弱引用，只能不缓存
+                    self.uncacheable += 1
+                    return functools.partial(self.func, obj)
+                bound = self._instances[key] = self._bind(obj)
+        return bound
+
+    def cache_info(self):
+        """命中、未命中、淘汰等统计"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'uncacheable': self.uncacheable,
+                'size': len(self._store),
+                'maxsize': self.maxsize,
+                'policy': self.policy,
+            }
+
+    def cache_clear(self):
+        with self._lock:
+            self._store.clear()
+            self.hits = self.misses = self.evictions = self.expirations = self.uncacheable = 0
+
+
+def memoized(func=None, maxsize=128, policy='lru', ttl=None, key=make_key):
+    """
+    缓存函数的返回值。
+
+    maxsize是最多缓存多少个结果，None表示不限制；policy是满了之后的淘汰策略，'lru'或者'lfu'；
+    ttl是结果的有效期（秒），None表示一直有效；key是把(args, kwargs)变成缓存key的函数。
 
-@memoized
+    既可以直接用@memoized，也可以带参数@memoized(maxsize=1000, policy='lfu', ttl=60)
+    装饰async def时会换成下面的AsyncMemoized，缓存的是await之后的结果而不是协程对象。
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            return AsyncMemoized(func, maxsize, policy, ttl, key)
+        return Memoized(func, maxsize, policy, ttl, key)
+    if func is None:
+        return decorator
+    return decorator(func)
+
+@memoized(maxsize=None)
 def fibonacci(n):
     if n in (0, 1):
         return n
     return fibonacci(n-1) + fibonacci(n-2)
-print fibonacci(12)
+print(fibonacci(12))
+print(fibonacci.cache_info())
+
+
+# 异步函数的缓存
+# 直接用上面的memoized装饰async def的话，缓存起来的是协程对象，第二次await就会报错。
+# 另外缓存没命中时，同一个key的很多并发请求会同时去调用后端（缓存击穿），
+# 这里让同一个key同时只有一个调用在跑，其它请求都等这一个的结果。
+
+
+class AsyncMemoized(Memoized):
+    """
+    缓存协程函数的结果。
+
+    ttl是结果的新鲜期；stale_ttl是过了新鲜期之后还能继续用旧值的时间，这段时间里请求直接拿旧值，
+    同时在后台刷新（stale-while-revalidate），所以热点key不会因为刷新而卡住。
+    """
+
+    def __init__(self, func, maxsize=128, policy='lru', ttl=None, key=make_key, stale_ttl=None):
+        # 过期自己管理，底下的存储不设ttl
+        super().__init__(func, maxsize, policy, None, key)
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._inflight = {} # key -> 正在跑的Task
+        self.coalesced = self.stale_hits = 0
+
+    def _bind(self, obj):
+        bound = type(self)(
+            functools.partial(self.func, obj),
+            self.maxsize, self.policy, self.ttl, self.key, self.stale_ttl,
+        )
+        functools.update_wrapper(bound, self.func)
+        return bound
+
+    async def __call__(self, *args, **kwargs):
+        try:
+            key = self.key(args, kwargs)
+        except TypeError:
+            self.uncacheable += 1
+            return await self.func(*args, **kwargs)
+        with self._lock:
+            item, _ = self._store.get(key)
+        if item is not _MISSING:
+            value, fresh_until, stale_until = item
+            now = time.monotonic()
+            if fresh_until is None or now < fresh_until:
+                self.hits += 1
+                return value
+            if stale_until is not None and now < stale_until:
+                # 先把旧值返回去，后台刷新，刷新只会有一个
+                self.hits += 1
+                self.stale_hits += 1
+                if self._running(key) is None:
+                    self._start(key, args, kwargs)
+                return value
+            self.expirations += 1
+        task = self._running(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._start(key, args, kwargs)
+        # shield：某一个等待者被取消了，不影响其它还在等同一个结果的请求
+        return await asyncio.shield(task)
+
+    def _running(self, key):
+        """key正在跑的Task；别的事件循环里留下来的不算"""
+        task = self._inflight.get(key)
+        if task is not None and task.get_loop() is not asyncio.get_running_loop():
+            return None
+        return task
+
+    def _start(self, key, args, kwargs):
+        task = asyncio.ensure_future(self._load(key, args, kwargs))
+        self._inflight[key] = task
+        # 后台刷新失败时没有人等着，取一下异常，不然会有"exception was never retrieved"的警告
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _load(self, key, args, kwargs):
+        try:
+            value = await self.func(*args, **kwargs)
+            fresh_until = stale_until = None
+            if self.ttl is not None:
+                fresh_until = time.monotonic() + self.ttl
+                if self.stale_ttl is not None:
+                    stale_until = fresh_until + self.stale_ttl
+            with self._lock:
+                self.evictions += self._store.set(key, (value, fresh_until, stale_until))
+            return value
+        finally:
+            # 出错了也要清掉，下一个请求会重新调用
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+
+    def cache_info(self):
+        info = super().cache_info()
+        info.update(coalesced=self.coalesced, stale_hits=self.stale_hits,
+                    inflight=len(self._inflight))
+        return info
+
+
+def async_memoized(func=None, maxsize=128, policy='lru', ttl=None, stale_ttl=None, key=make_key):
+    """
+    缓存协程函数的结果，同一个key的并发调用只会真正执行一次。
+
+        @async_memoized(ttl=30, stale_ttl=300)
+        async def get_user(user_id):
+            ...
+    """
+    def decorator(func):
+        return AsyncMemoized(func, maxsize, policy, ttl, key, stale_ttl)
+    if func is None:
+        return decorator
+    return decorator(func)
+
+@async_memoized(ttl=1, stale_ttl=10)
+async def fetch_price(symbol):
+    await asyncio.sleep(0.1) # 假装是一次网络请求
+    return len(symbol) * 100
+
+async def many_requests():
+    # 100个并发请求，fetch_price只会真正执行一次
+    prices = await asyncio.gather(*(fetch_price('AAPL') for _ in range(100)))
+    print(prices[0], fetch_price.cache_info())
 
+asyncio.run(many_requests())
+
+
+# 跨进程、跨重启的缓存
+# 上面的缓存都只活在一个进程里，多进程的worker各算各的，重启之后也要从头再算。
+# 这里把结果存到一个用mmap打开的文件里，所有进程共用，重启之后还在。
+# 用到了fcntl.flock，只支持类Unix系统。
+
+
+class MmapStore(object):
+    """
+    一个存在文件里的哈希表，key是16字节的摘要，value是bytes。
+
+    文件布局：
+        头部    魔数(8) 槽数(8) 数据区大小(8) 写指针(8)
+        槽表    每个槽是 摘要(16) 记录的偏移(8)，偏移为0表示空槽
+        数据区  一条条记录 摘要(16) 长度(4) crc32(4) 值
+
+    数据区是一个环形缓冲区，写到头了就从开始的地方覆盖最老的记录，所以文件大小是固定的（FIFO淘汰）。
+    槽指向的记录被覆盖之后，记录里的摘要或者crc就对不上了，读的时候会当作没有。
+    进程之间用flock加锁：读用共享锁，写用排它锁；同一个进程里的线程用threading.Lock。
+    """
+
+    MAGIC = b'MEMOMAP1'
+    HEADER = struct.Struct('<8sQQQ')
+    SLOT = struct.Struct('<16sQ')
+    RECORD = struct.Struct('<16sII')
+    MAX_PROBE = 16 # 线性探测最多找这么多个槽，找不到就覆盖第一个
+
+    def __init__(self, path, size=64 << 20, slots=1 << 16):
+        self.path = path
+        self.size = size
+        self.slots = slots
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        """
+        打开并映射文件。fork出来的子进程要重新打开：flock的锁是跟着打开的文件走的，
+        和父进程共用一个文件的话，两边的锁就互相不起作用了。
+        """
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            # fork出来的子进程：先把从父进程继承来的映射和文件描述符关掉，不然每个子进程都漏一个
+            self._mm.close()
+            os.close(self._fd)
+            self._pid = None
+        fd = self._open_file()
+        try:
+            self._init_file(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._data_start = self.HEADER.size + self.slots * self.SLOT.size
+        self._data_end = self._data_start + self.size
+        self._mm = mmap.mmap(fd, self._data_end)
+        self._pid = os.getpid()
+
+    def _open_file(self):
+        """
+        新建的文件用O_EXCL创建，权限是0o600；已经存在的文件要是自己的，而且别人不能写。
+        值是用pickle读回来的，别人能改这个文件的话就能让我们执行任意代码。
+        """
+        flags = os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0) # 不跟着符号链接走
+        try:
+            return os.open(self.path, flags | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        fd = os.open(self.path, flags)
+        st = os.fstat(fd)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            os.close(fd)
+            raise PermissionError(
+                '%s is not owned by the current user or is writable by others' % self.path)
+        return fd
+
+    def _init_file(self, fd):
+        """新文件写好头部，已有的文件读出头部里的大小"""
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                data_start = self.HEADER.size + self.slots * self.SLOT.size
+                os.ftruncate(fd, data_start + self.size)
+                os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.slots, self.size, data_start), 0)
+            header = os.pread(fd, self.HEADER.size, 0)
+            magic, self.slots, self.size, _ = self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                raise ValueError('%s is not a memo store' % self.path)
+            # 以文件头里的大小为准，文件比头里说的短的话就是坏了
+            if os.fstat(fd).st_size < self.HEADER.size + self.slots * self.SLOT.size + self.size:
+                raise ValueError('%s is truncated' % self.path)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _slot_offset(self, index):
+        return self.HEADER.size + index * self.SLOT.size
+
+    def _probe(self, digest):
+        home = int.from_bytes(digest[:8], 'little') % self.slots
+        for i in range(self.MAX_PROBE):
+            yield (home + i) % self.slots
+
+    def _record_is(self, offset, digest):
+        """offset处的记录还是不是digest的"""
+        return self.RECORD.unpack_from(self._mm, offset)[0] == digest
+
+    def _read(self, digest):
+        for index in self._probe(digest):
+            slot_digest, offset = self.SLOT.unpack_from(self._mm, self._slot_offset(index))
+            if offset == 0:
+                return None
+            if slot_digest != digest:
+                continue
+            record_digest, length, crc = self.RECORD.unpack_from(self._mm, offset)
+            start = offset + self.RECORD.size
+            if record_digest != digest or start + length > self._data_end:
+                return None
+            data = self._mm[start:start + length]
+            if zlib.crc32(data) != crc:
+                return None
+            return data
+        return None
+
+    def get(self, digest):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                data = self._read(digest)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return data
+
+    def set(self, digest, data):
+        """存进去；值比整个数据区还大的话存不下，返回False"""
+        need = self.RECORD.size + len(data)
+        with self._lock:
+            # 打开以后self.size才是文件里的实际大小，构造时传的size对已经存在的文件不算数
+            self._open()
+            if need > self.size:
+                return False
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                mm = self._mm
+                offset = self.HEADER.unpack_from(mm, 0)[3]
+                if offset + need > self._data_end:
+                    offset = self._data_start # 绕回开头，覆盖最老的记录
+                self.RECORD.pack_into(mm, offset, digest, len(data), zlib.crc32(data))
+                mm[offset + self.RECORD.size:offset + need] = data
+                self.HEADER.pack_into(mm, 0, self.MAGIC, self.slots, self.size, offset + need)
+                # 找一个槽：同一个key的、空的、或者指向的记录已经被覆盖了的
+                target = None
+                for index in self._probe(digest):
+                    slot_digest, slot_offset = self.SLOT.unpack_from(mm, self._slot_offset(index))
+                    if (slot_digest == digest or slot_offset == 0
+                            or not self._record_is(slot_offset, slot_digest)):
+                        target = index
+                        break
+                if target is None:
+                    target = next(self._probe(digest))
+                self.SLOT.pack_into(mm, self._slot_offset(target), digest, offset)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return True
+
+
+# 这些类型的repr能完整、唯一地表示值，float的repr也是能原样读回来的
+_EXACT_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+
+def _stable_repr(value):
+    """
+    参数的稳定表示，不同进程、不同次运行得到的结果都一样。
+
+    set的遍历顺序受字符串哈希随机化的影响，pickle的结果也会跟着变，所以自己排序。
+    只认能完整表示出来的类型：上面那几种基本类型和由它们组成的list、tuple、set、dict，
+    还有numpy数组（用dtype、shape和原始字节）。别的对象的repr可能被截断，
+    比如大数组和DataFrame中间是...，不同的值会撞到同一个key上，所以直接抛TypeError。
+    """
+    kind = type(value)
+    if kind in _EXACT_TYPES:
+        return '%s:%r' % (kind.__qualname__, value)
+    if kind in (list, tuple):
+        return '%s(%s)' % (kind.__name__, ','.join(_stable_repr(v) for v in value))
+    if kind in (set, frozenset):
+        return 'set(%s)' % ','.join(sorted(_stable_repr(v) for v in value))
+    if kind is dict:
+        items = sorted('%s:%s' % (_stable_repr(k), _stable_repr(v)) for k, v in value.items())
+        return 'dict(%s)' % ','.join(items)
+    dtype = getattr(value, 'dtype', None)
+    if kind.__name__ == 'ndarray' and dtype is not None and not dtype.hasobject:
+        # object数组的字节是指针，不能用
+        digest = hashlib.blake2b(value.tobytes()).hexdigest()
+        return 'ndarray(%s,%r,%s)' % (dtype.str, value.shape, digest)
+    raise TypeError('no stable key for %s' % kind.__qualname__)
+
+
+def _function_fingerprint(func):
+    """函数的源码变了，以前存的结果就不能再用了"""
+    try:
+        source = inspect.getsource(func).encode('utf-8')
+    except (OSError, TypeError):
+        source = func.__code__.co_code
+    name = '%s.%s' % (func.__module__, func.__qualname__)
+    return name.encode('utf-8') + b'\0' + hashlib.blake2b(source).digest()
+
+
+# 缓存文件打不开、坏了之类的错误，不应该让被装饰的函数调用失败
+_STORE_ERRORS = (OSError, ValueError, IndexError, struct.error)
+
+
+def persistent_memoized(path, size=64 << 20, slots=1 << 16):
+    """
+    把函数的结果存到path这个文件里，多个进程可以同时读写，重启之后也还在。
+
+    key是函数源码和参数的摘要，所以改了函数之后旧的结果自然就用不上了。
+    参数只能是基本类型、由它们组成的容器或者numpy数组，其它参数的调用不缓存，见_stable_repr。
+    size是数据区的字节数，满了之后覆盖最老的结果；返回值要能被pickle。
+
+        @persistent_memoized('/var/cache/experiment.memo', size=256 << 20)
+        def run_experiment(niter=100):
+            ...
+    """
+    store = MmapStore(path, size, slots)
+
+    def decorator(func):
+        fingerprint = _function_fingerprint(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                key = _stable_repr((args, kwargs)).encode('utf-8')
+            except TypeError:
+                return func(*args, **kwargs) # 参数没法稳定地表示，这次不走缓存
+            digest = hashlib.blake2b(fingerprint + b'\0' + key, digest_size=16).digest()
+            try:
+                data = store.get(digest)
+            except _STORE_ERRORS:
+                data = None # 缓存文件读不了就当没命中
+            if data is not None:
+                return pickle.loads(data)
+            value = func(*args, **kwargs)
+            try:
+                store.set(digest, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            except (pickle.PicklingError, TypeError, AttributeError) + _STORE_ERRORS:
+                pass # 存不了就算了，结果照样返回
+            return value
+        wrapper.store = store
+        return wrapper
+    return decorator
+
+def user_cache_dir(name):
+    """
+    当前用户自己的缓存目录，比如~/.cache/name，权限是0o700。
+
+    不要用/tmp下面固定的文件名：谁都能在那里先放一个文件，里面的pickle会被我们读回来执行。
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, name)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+@persistent_memoized(os.path.join(user_cache_dir('about_decorators'), 'slow_fibonacci.memo'))
+def slow_fibonacci(n):
+    if n in (0, 1):
+        return n
+    return slow_fibonacci(n-1) + slow_fibonacci(n-2)
+# 第二次运行这个脚本时，所有结果都直接从文件里读出来
+print(slow_fibonacci(30), slow_fibonacci.store.hits, slow_fibonacci.store.misses)
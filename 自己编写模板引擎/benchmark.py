@@ -0,0 +1,207 @@
+"""
+Templite的性能测试
+
+    python benchmark.py                          # 跑一遍，打印结果
+    python benchmark.py -o results.json          # 结果保存成JSON
+    python benchmark.py --compare results.json   # 和之前保存的结果比较，变慢超过阈值就返回1
+
+每个用例跑若干轮，取最快的一轮，换算成每秒能跑多少次（ops）。
+string.Template和str.format作为参照，看看模板引擎本身的开销有多大。
+"""
+
+import argparse
+import json
+import platform
+import string
+import sys
+import time
+import tracemalloc
+
+from template import Templite, TemplateCache
+
+
+# 不缓存的TemplateCache，用来测编译时间
+NO_CACHE = TemplateCache(maxsize=0)
+
+
+def measure(func, number, repeat=5):
+    """跑repeat轮，每轮调用number次，返回最快那一轮的每秒次数"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return number / best
+
+
+def peak_memory(func):
+    """func执行过程中Python分配内存的峰值，单位字节"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_compile():
+    """编译时间和模板大小的关系"""
+    results = {}
+    block = '<p>{{user.name|upper}}</p>{% for x in items %}{% if x %}{{x}}{% endif %}{% endfor %}\n'
+    for size in (10, 100, 1000):
+        text = block * size
+        ops = measure(lambda: Templite(text, cache=NO_CACHE), max(1, 1000 // size))
+        results['compile_%d_blocks' % size] = ops
+    text = block * 100
+    cache = TemplateCache()
+    Templite(text, cache=cache)
+    results['compile_100_blocks_cached'] = measure(lambda: Templite(text, cache=cache), 1000)
+    return results
+
+
+def bench_loops():
+    """三层嵌套循环"""
+    text = (
+        '{% for a in rows %}<tr>{% for b in a %}<td>'
+        '{% for c in b %}{{c}},{% endfor %}'
+        '</td>{% endfor %}</tr>{% endfor %}'
+    )
+    rows = [[list(range(10)) for _ in range(10)] for _ in range(10)]
+    templite = Templite(text)
+    return {'deep_loops': measure(lambda: templite.render({'rows': rows}), 50)}
+
+
+def bench_dots():
+    """循环里的取点操作，_do_dots和inline_dots两种模式"""
+    text = '{% for u in users %}{{u.name}} {{u.profile.city}} {{u.profile.zip}}\n{% endfor %}'
+    users = [
+        {'name': 'user%d' % i, 'profile': {'city': 'city%d' % i, 'zip': i}}
+        for i in range(1000)
+    ]
+    results = {}
+    for inline in (False, True):
+        templite = Templite(text, inline_dots=inline)
+        key = 'dots_inline' if inline else 'dots'
+        results[key] = measure(lambda: templite.render({'users': users}), 20)
+    return results
+
+
+def bench_filters():
+    """过滤器链"""
+    text = '{% for w in words %}{{w|strip|lower|title|upper}}{% endfor %}'
+    filters = {'strip': str.strip, 'lower': str.lower, 'title': str.title, 'upper': str.upper}
+    words = [' Word%d ' % i for i in range(1000)]
+    templite = Templite(text, filters)
+    return {'filter_chain': measure(lambda: templite.render({'words': words}), 50)}
+
+
+def bench_small_renders():
+    """很多次很小的渲染，主要看每次调用的固定开销"""
+    templite = Templite('Hello {{name}}, you have {{count}} new messages.')
+    template = string.Template('Hello $name, you have $count new messages.')
+    fmt = 'Hello {name}, you have {count} new messages.'
+    context = {'name': 'Ned', 'count': 3}
+    contexts = [context] * 1000
+    return {
+        'small_render': measure(lambda: templite.render(context), 10000),
+        'small_render_many': measure(lambda: list(templite.render_many(contexts)), 10) * 1000,
+        'baseline_string_template': measure(lambda: template.substitute(context), 10000),
+        'baseline_str_format': measure(lambda: fmt.format(**context), 10000),
+    }
+
+
+def bench_loop_baselines():
+    """大循环和str.format拼接的对比"""
+    templite = Templite('{% for r in rows %}<li>{{r}}</li>{% endfor %}')
+    rows = ['row%d' % i for i in range(10000)]
+    return {
+        'big_loop': measure(lambda: templite.render({'rows': rows}), 20),
+        'baseline_big_loop_format': measure(
+            lambda: ''.join('<li>{}</li>'.format(r) for r in rows), 20
+        ),
+    }
+
+
+def bench_memory():
+    """大页面渲染时的内存峰值，一次性渲染和流式渲染对比（单位字节，越小越好）"""
+    templite = Templite('{% for r in rows %}<li>{{r}} {{r}} {{r}}</li>\n{% endfor %}')
+    context = {'rows': ['row%d' % i for i in range(100000)]}
+
+    def stream():
+        for _ in templite.render_iter(context):
+            pass
+
+    return {
+        'peak_bytes_render': peak_memory(lambda: templite.render(context)),
+        'peak_bytes_render_iter': peak_memory(stream),
+    }
+
+
+BENCHMARKS = [
+    bench_compile, bench_loops, bench_dots, bench_filters,
+    bench_small_renders, bench_loop_baselines, bench_memory,
+]
+
+
+def run():
+    results = {}
+    for bench in BENCHMARKS:
+        results.update(bench())
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': results,
+    }
+
+
+def compare(old, new, threshold):
+    """
+    找出变差的用例。ops越大越好，peak_bytes越小越好；baseline_开头的是参照，不算。
+    返回[(名字, 旧值, 新值, 变化比例)]
+    """
+    regressions = []
+    for name, new_value in new['results'].items():
+        old_value = old['results'].get(name)
+        if not old_value or name.startswith('baseline_'):
+            continue
+        if name.startswith('peak_bytes'):
+            change = new_value / old_value - 1
+        else:
+            change = old_value / new_value - 1
+        if change > threshold:
+            regressions.append((name, old_value, new_value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-o', '--output', help='结果保存到这个JSON文件')
+    parser.add_argument('--compare', help='和这个JSON文件里的结果比较')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='变差超过这个比例就算退化，默认0.1也就是10%%')
+    args = parser.parse_args(argv)
+
+    report = run()
+    for name, value in sorted(report['results'].items()):
+        unit = 'bytes' if name.startswith('peak_bytes') else 'ops/s'
+        print('%-32s %14.1f %s' % (name, value, unit))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old, report, args.threshold)
+        for name, old_value, new_value, change in regressions:
+            print('REGRESSION %s: %.1f -> %.1f (%+.0f%%)' % (name, old_value, new_value, change * 100))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
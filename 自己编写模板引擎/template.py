@@ -4,7 +4,20 @@
 """
 
 
+import asyncio
+import builtins
+import hashlib
+import importlib.util
+import inspect
+import itertools
+import marshal
+import multiprocessing
+import os
 import re
+import threading
+import time
+import types
+from collections import OrderedDict
 
 
 class TempliteSyntaxError(ValueError):
@@ -12,6 +25,117 @@ class TempliteSyntaxError(ValueError):
     pass
 
 
+class TemplateNotFound(LookupError):
+    """extends或者include的模板在loader里找不到"""
+    pass
+
+
+class DictLoader(object):
+    """
+    最简单的模板加载器，模板都放在一个字典里，{名字: 模板源码}。
+
+    {% extends %}和{% include %}通过loader的get_source按名字取模板源码。
+    """
+
+    def __init__(self, templates):
+        self.templates = templates
+
+    def get_source(self, name):
+        try:
+            return self.templates[name]
+        except KeyError:
+            raise TemplateNotFound(name)
+
+
+class FileSystemLoader(object):
+    """
+    从一个目录里加载模板。
+
+    get_template第一次用到某个模板时才编译，编译好的Templite按名字缓存起来。
+    auto_reload为True时，每次get_template都会检查模板文件和它extends、include的文件的
+    mtime和大小，有变化才重新编译；生产环境设成False，就只剩一次字典查找。
+
+        loader = FileSystemLoader('templates', {'upper': str.upper}, auto_reload=False)
+        text = loader.get_template('index.html').render(context)
+
+    contexts和其它关键字参数会原样传给Templite。
+    """
+
+    def __init__(self, directory, *contexts, auto_reload=True, encoding='utf-8', **options):
+        self.directory = os.path.abspath(directory)
+        self.contexts = contexts
+        self.auto_reload = auto_reload
+        self.encoding = encoding
+        self.options = options
+        self._templates = {} # 名字 -> (Templite, 依赖文件的快照)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # render_many要把loader发给子进程，编译好的模板和锁都不需要带过去
+        state = self.__dict__.copy()
+        state['_templates'] = {}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        """模板名字对应的文件路径，不允许用../跑到目录外面去"""
+        path = os.path.normpath(os.path.join(self.directory, name))
+        if not path.startswith(self.directory + os.sep):
+            raise TemplateNotFound(name)
+        return path
+
+    def get_source(self, name):
+        try:
+            with open(self._path(name), encoding=self.encoding) as f:
+                return f.read()
+        except OSError:
+            raise TemplateNotFound(name)
+
+    def _stat(self, name):
+        try:
+            st = os.stat(self._path(name))
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _snapshot(self, names):
+        return tuple((name, self._stat(name)) for name in names)
+
+    def _unchanged(self, snapshot):
+        for name, stat in snapshot:
+            if self._stat(name) != stat:
+                return False
+        return True
+
+    def get_template(self, name):
+        item = self._templates.get(name)
+        if item is not None:
+            templite, snapshot = item
+            if not self.auto_reload or self._unchanged(snapshot):
+                return templite
+        with self._lock:
+            # 先记下文件状态再读文件，编译期间文件被改了的话下次还会重新编译
+            stat = self._stat(name)
+            templite = Templite(
+                self.get_source(name), *self.contexts,
+                loader=self, name=name, **self.options
+            )
+            snapshot = ((name, stat),) + self._snapshot(templite.deps)
+            self._templates[name] = (templite, snapshot)
+        return templite
+
+    def invalidate(self, name):
+        """丢掉name和所有extends、include了name的模板，下次用到时重新编译"""
+        with self._lock:
+            for other, (templite, _) in list(self._templates.items()):
+                if other == name or name in templite.deps:
+                    del self._templates[other]
+
+
 class CodeBuilder(object):
     """这是一个代码生成器，用来添加缩进之类的，退回缩进等等功能。"""
 
@@ -60,6 +184,455 @@ class CodeBuilder(object):
         return global_namespace
 
 
+class TemplateCache(object):
+    """
+    编译结果的缓存。
+
+    内存里是一个LRU（OrderedDict实现），满了就淘汰最久没用过的；如果给了directory，
+    编译出来的code对象还会用marshal写到磁盘上，进程重启之后可以直接读回来，
+    省掉分词、生成代码和exec这几步。
+    """
+
+    SUFFIX = '.tplc'
+
+    def __init__(self, maxsize=256, directory=None):
+        self.maxsize = maxsize # maxsize为0时相当于关闭内存缓存
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(text, options=''):
+        """模板源码加上编译选项的哈希值，作为缓存的key"""
+        source = '%s\0%s' % (options, text)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """先查内存，再查磁盘，都没有就返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key) # 最近用过的挪到队尾
+                return entry
+        entry = self._load(key)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        self._remember(key, entry)
+        self._dump(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, entry):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False) # 淘汰队头，也就是最久没用的
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _load(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        # 文件头是解释器的MAGIC_NUMBER，换了Python版本code对象就不能用了。
+        magic = importlib.util.MAGIC_NUMBER
+        if not data.startswith(magic):
+            return None
+        try:
+            return marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def _dump(self, key, entry):
+        if not self.directory:
+            return
+        path = self._path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(importlib.util.MAGIC_NUMBER)
+            f.write(marshal.dumps(entry))
+        os.replace(tmp_path, path) # 原子替换，其它进程不会读到写了一半的文件
+
+
+# 不指定cache时，所有的Templite共用这一个内存缓存。
+default_cache = TemplateCache()
+
+
+class FragmentCache(object):
+    """
+    {% cache %}标签用的片段缓存，有容量上限的LRU，每一项都有自己的过期时间。
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict() # key -> (过期时间, 渲染好的片段)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """取出没过期的片段，没有或者过期了返回None"""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, fragment = item
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return fragment
+
+    def set(self, key, fragment, ttl):
+        """ttl的单位是秒"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, fragment)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+default_fragment_cache = FragmentCache()
+
+# 每个Templite一个编号，放在片段缓存的key里。源码一样但是全局context、过滤器不一样的模板
+# 渲染出来的片段也不一样，不能共用
+_fragment_scopes = itertools.count()
+
+
+def _vary_key(value):
+    """{% cache %}后面的表达式的值要放进key里，必须是可哈希的"""
+    try:
+        hash(value)
+    except TypeError:
+        raise TempliteSyntaxError(
+            "cache语句的参数必须是可哈希的，比如数字、字符串: %r" % (value,)
+        ) from None
+    return value
+
+
+# 取点操作的两种策略：用[]取key，或者用getattr取属性。
+_KEY, _ATTR = 0, 1
+_HEAPTYPE = 1 << 9 # Py_TPFLAGS_HEAPTYPE，用class语句定义出来的类型都有这个标志
+
+
+def _dot_strategy(cls, dot):
+    """
+    判断cls类型的对象取dot时应该用哪种策略。
+
+    像dict这种没有实例__dict__、也没有自定义属性查找的类型，如果类型上没有名为dot的属性，
+    getattr一定会抛AttributeError，那就可以直接用[]，省掉一次try/except。
+    """
+    if cls.__dictoffset__ == 0 and not hasattr(cls, dot) \
+            and not hasattr(cls, '__getattr__') \
+            and not any(c.__flags__ & _HEAPTYPE and '__getattribute__' in c.__dict__
+                        for c in cls.__mro__):
+        return _KEY
+    return _ATTR
+
+
+def _make_dot_site(dots):
+    """
+    为模板里的一处a.b.c生成专用的取值函数。
+
+    每一步都按对象的类型缓存取值策略，语义和Templite._do_dots一样：
+    先getattr，失败了再用[]，取到的东西如果可以调用就调用一下。
+    """
+    if len(dots) == 1:
+        # 最常见的是只有一个点，单独展开，省掉循环。
+        dot = dots[0]
+        strategies = {}
+
+        def resolve(value):
+            cls = type(value)
+            how = strategies.get(cls)
+            if how is None:
+                how = strategies[cls] = _dot_strategy(cls, dot)
+            if how is _KEY:
+                value = value[dot]
+            else:
+                try:
+                    value = getattr(value, dot)
+                except AttributeError:
+                    value = value[dot]
+            if callable(value):
+                value = value()
+            return value
+        return resolve
+
+    steps = tuple((dot, {}) for dot in dots)
+
+    def resolve(value):
+        for dot, strategies in steps:
+            cls = type(value)
+            how = strategies.get(cls)
+            if how is None:
+                how = strategies[cls] = _dot_strategy(cls, dot)
+            if how is _KEY:
+                value = value[dot]
+            else:
+                try:
+                    value = getattr(value, dot)
+                except AttributeError:
+                    value = value[dot]
+            if callable(value):
+                value = value()
+        return value
+    return resolve
+
+
+class Markup(str):
+    """标记为安全的字符串，自动转义时原样输出"""
+
+    def __html__(self):
+        return self
+
+
+# 一次str.translate就能把所有特殊字符换掉，不用一遍一遍地str.replace
+_ESCAPE_TABLE = {
+    ord('&'): '&amp;',
+    ord('<'): '&lt;',
+    ord('>'): '&gt;',
+    ord('"'): '&#34;',
+    ord("'"): '&#39;',
+}
+
+
+def escape(value):
+    """HTML转义，有__html__方法的对象（比如Markup）认为是安全的"""
+    cls = type(value)
+    if cls is str:
+        return value.translate(_ESCAPE_TABLE)
+    if cls is int or cls is float:
+        return str(value) # 数字里不会有需要转义的字符
+    if hasattr(value, '__html__'):
+        return value.__html__()
+    return str(value).translate(_ESCAPE_TABLE)
+
+
+def _make_escape_memo():
+    """
+    循环里用的转义函数，每次渲染新建一个。
+
+    同一次渲染里重复出现的字符串只转义一次，字符串是不可变的，所以可以放心地缓存。
+    """
+    memo = {}
+
+    def escape_memo(value):
+        if type(value) is str:
+            result = memo.get(value)
+            if result is None:
+                result = memo[value] = value.translate(_ESCAPE_TABLE)
+            return result
+        return escape(value)
+    return escape_memo
+
+
+class _TemplateProbe(object):
+    """Profiler绑定到某一个模板上，生成的代码通过它上报for循环、过滤器和取点操作的耗时"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def record(self, kind, label, seconds):
+        self.profiler.record(self.name, '%s:%s' % (kind, label), seconds)
+
+    def call(self, kind, label, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.record(kind, label, time.perf_counter() - start)
+
+    async def acall(self, kind, label, func, *args):
+        start = time.perf_counter()
+        try:
+            return await _await_value(func(*args))
+        finally:
+            self.record(kind, label, time.perf_counter() - start)
+
+
+class Profiler(object):
+    """
+    模板的性能统计，按模板名字分别统计：
+
+    - 编译次数和耗时
+    - 渲染次数、总耗时和耗时分布（按2的幂次分桶的直方图，单位微秒）
+    - 每个for循环、每个过滤器、每个取点操作的调用次数、总耗时和最大耗时
+
+    给Templite传了profiler才会在生成的代码里插入统计代码，不传的话没有任何开销。
+
+        profiler = Profiler()
+        templite = Templite(text, profiler=profiler)
+        templite.render(context)
+        profiler.stats()
+    """
+
+    HISTOGRAM_BUCKETS = 32 # 最后一个桶是 >= 2**30微秒
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def probe(self, name):
+        return _TemplateProbe(self, name)
+
+    def _template(self, name):
+        stats = self._templates.get(name)
+        if stats is None:
+            stats = self._templates[name] = {
+                'compiles': 0,
+                'compile_time': 0.0,
+                'renders': 0,
+                'render_time': 0.0,
+                'render_histogram': [0] * self.HISTOGRAM_BUCKETS,
+                'tags': {},
+            }
+        return stats
+
+    def record_compile(self, name, seconds):
+        with self._lock:
+            stats = self._template(name)
+            stats['compiles'] += 1
+            stats['compile_time'] += seconds
+
+    def record_render(self, name, seconds):
+        bucket = min(int(seconds * 1e6).bit_length(), self.HISTOGRAM_BUCKETS - 1)
+        with self._lock:
+            stats = self._template(name)
+            stats['renders'] += 1
+            stats['render_time'] += seconds
+            stats['render_histogram'][bucket] += 1
+
+    def record(self, name, tag, seconds):
+        with self._lock:
+            tags = self._template(name)['tags']
+            item = tags.get(tag)
+            if item is None:
+                item = tags[tag] = {'count': 0, 'total': 0.0, 'max': 0.0}
+            item['count'] += 1
+            item['total'] += seconds
+            if seconds > item['max']:
+                item['max'] = seconds
+
+    def record_tags(self, name, tags):
+        """合并别处统计好的标签耗时，比如render_many子进程里的，tags的格式和stats()里的一样"""
+        with self._lock:
+            own = self._template(name)['tags']
+            for tag, other in tags.items():
+                item = own.get(tag)
+                if item is None:
+                    own[tag] = dict(other)
+                    continue
+                item['count'] += other['count']
+                item['total'] += other['total']
+                if other['max'] > item['max']:
+                    item['max'] = other['max']
+
+    def stats(self):
+        """返回一个可以直接转成JSON的字典，直方图的key是桶的上界，比如'<2us'"""
+        result = {}
+        with self._lock:
+            for name, stats in self._templates.items():
+                histogram = {
+                    '<%dus' % (1 << i): count
+                    for i, count in enumerate(stats['render_histogram']) if count
+                }
+                result[name] = dict(
+                    stats,
+                    render_histogram=histogram,
+                    tags={tag: dict(item) for tag, item in stats['tags'].items()},
+                )
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._templates.clear()
+
+
+async def _await_value(value):
+    """值是可等待对象（协程、Future等）就await一下，否则原样返回"""
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+
+class _AwaitMemo(object):
+    """
+    一次render_async里await过的对象和结果。
+
+    协程只能await一次，模板里{{c.d}}出现两次的话，第二次就会出错，
+    所以每个可等待对象包成一个Task，按id记下来，再次遇到直接等同一个Task。
+    """
+
+    def __init__(self):
+        self._tasks = {} # id -> (可等待对象, Task)，留着原对象，id才不会被复用
+
+    async def resolve(self, value):
+        if not inspect.isawaitable(value):
+            return value
+        item = self._tasks.get(id(value))
+        if item is None:
+            item = self._tasks[id(value)] = (value, asyncio.ensure_future(value))
+        return await item[1]
+
+    async def do_dots(self, value, *dots):
+        """_do_dots的异步版本，每一步取到的值如果是可等待对象，先await再往下取"""
+        for dot in dots:
+            value = await self.resolve(value)
+            try:
+                value = getattr(value, dot)
+            except AttributeError:
+                value = value[dot]
+            if callable(value):
+                value = value()
+        return await self.resolve(value)
+
+
+async def _gather_items(iterable):
+    """
+    异步模式下for循环遍历的对象。
+
+    支持异步迭代器；列表里的可等待对象用asyncio.gather并发地等待，而不是一个一个地等。
+    """
+    iterable = await _await_value(iterable)
+    if hasattr(iterable, '__aiter__'):
+        items = [item async for item in iterable]
+    else:
+        items = list(iterable)
+    pending = [i for i, item in enumerate(items) if inspect.isawaitable(item)]
+    if pending:
+        values = await asyncio.gather(*(items[i] for i in pending))
+        for i, value in zip(pending, values):
+            items[i] = value
+    return items
+
+
 class Templite(object):
     """
 
@@ -79,6 +652,19 @@ class Templite(object):
 
         {# This will be ignored #}
 
+    支持模板继承和包含（需要传入loader）:
+
+        {% extends "base.html" %}
+        {% block content %}...{% endblock %}
+        {% include "nav.html" %}
+
+    extends和include在编译时就链接好，最后还是只有一个render_function。
+
+    支持片段缓存，name是片段的名字，ttl是过期秒数，后面可以跟若干个表达式，值不同缓存也不同，
+    这些值必须是可哈希的。片段只在同一个Templite对象里共用:
+
+        {% cache nav 300 user.id %}...{% endcache %}
+
     一个示例：
 
         templite = Templite('''
@@ -94,23 +680,137 @@ class Templite(object):
             'topics': ['Python', 'Geometry', 'Juggling'],
         })
 
+    支持编译缓存，相同的模板只会编译一次，给TemplateCache指定directory还可以跨进程复用:
+
+        cache = TemplateCache(maxsize=1000, directory='/tmp/templite')
+        templite = Templite(text, {'upper': str.upper}, cache=cache)
+
+    支持流式渲染，大的for循环不用把整页都攒在内存里:
+
+        for chunk in templite.render_iter(context, chunk_size=8192):
+            response.write(chunk)
+        templite.render_to(open('report.html', 'w'), context)
+
+    inline_dots=True时，每一处{{a.b.c}}都会编译成一个专用的取值函数，按类型缓存取值策略，
+    不再走_do_dots，循环里大量取点操作时快很多:
+
+        templite = Templite(text, inline_dots=True)
+
+    支持异步渲染，context里的协程会被并发地await，取点操作和过滤器返回的协程也会被await:
+
+        text = await templite.render_async({'user': fetch_user(), 'news': fetch_news()})
+
+    支持批量渲染，processes大于1时用进程池并行渲染，结果按contexts的顺序产出:
+
+        for text in templite.render_many(contexts, processes=4):
+            send_mail(text)
+
+    传入Profiler可以统计编译、渲染以及每个for循环、过滤器、取点操作的耗时，见Profiler。
+
+    autoescape=True时，{{ }}输出的值都会做HTML转义。模板里的文本、Markup对象不转义，
+    内置的safe过滤器把值标记为安全，写在最后时编译出的代码里直接就不调用转义函数了:
+
+        {{comment.body}} {{article.html|safe}}
+
     """
-    def __init__(self, text, *contexts):
+
+    # 流式模式下，for循环每迭代一次检查一下，攒够这么多片段就yield一次。
+    STREAM_FLUSH_FRAGMENTS = 64
+
+    def __init__(self, text, *contexts, cache=None, inline_dots=False,
+                 loader=None, fragment_cache=None, name='<string>', profiler=None,
+                 autoescape=False):
         """
         text是我们编写的模板，contexts是自定义的过滤器或者全局变量。
+        cache是TemplateCache对象，不传的话使用模块级的default_cache。
+        inline_dots为True时，取点操作编译成按调用点特化的代码，而不是调用_do_dots。
+        loader用来加载extends和include的模板，要有get_source(name)方法，比如DictLoader。
+        fragment_cache是{% cache %}用的FragmentCache，不传的话使用default_fragment_cache。
+        name是模板的名字，用loader加载时就是模板的文件名。
+        profiler是Profiler对象，传了才会统计耗时。
+        autoescape为True时，输出的值都做HTML转义。
         """
         self.context = {}
         for context in contexts:
             self.context.update(context)
-        print('self.context: ', self.context)
+
+        self.text = text
+        self.name = name
+        self.profiler = profiler
+        self.autoescape = autoescape
+        self.cache = default_cache if cache is None else cache
+        self.inline_dots = inline_dots
+        self.loader = loader
+        if fragment_cache is None:
+            fragment_cache = default_fragment_cache
+        self.fragment_cache = fragment_cache
+        self._fragment_scope = next(_fragment_scopes)
+
+        self._compiled = {} # mode -> (缓存的key, 编译结果)，render_many往子进程发的就是这个
+        self._render_function = self._load_function()
+        self._stream_function = None # 第一次调用render_iter时才编译
+        self._async_function = None # 第一次调用render_async时才编译
+
+    def _load_function(self, mode='render'):
+        """
+        从缓存中取出编译好的code对象，重新组装成函数，缓存里没有才去编译。
+        """
+        # 缓存里存的是render_function的code对象和变量集合，命中的话就不用再编译了。
+        options = 'mode=%s inline_dots=%d profile=%d autoescape=%d' % (
+            mode, self.inline_dots, self.profiler is not None, self.autoescape
+        )
+        key = self.cache.make_key(self.text, options)
+        entry = self.cache.get(key)
+        if entry is None or not self._deps_fresh(entry['deps']):
+            start = time.perf_counter()
+            entry = self._compile(self.text, mode)
+            if self.profiler is not None:
+                self.profiler.record_compile(self.name, time.perf_counter() - start)
+            self.cache.set(key, entry)
+        self._compiled[mode] = (key, entry)
+        self.all_vars = set(entry['all_vars'])
+        self.loop_vars = set(entry['loop_vars'])
+        self.deps = dict(entry['deps'])
+        namespace = {
+            '__builtins__': builtins,
+            'fragments': self.fragment_cache,
+            'fragment_scope': self._fragment_scope,
+            'vary_key': _vary_key,
+            'await_value': _await_value,
+            'gather_items': _gather_items,
+            'perf_counter': time.perf_counter,
+            'Markup': Markup,
+            'escape': escape,
+            'make_escape_memo': _make_escape_memo,
+            'probe': self.profiler.probe(self.name) if self.profiler is not None else None,
+            # 每个调用点一个取值函数，策略缓存跟着函数走，所以每次组装都新建。
+            'dot_sites': tuple(_make_dot_site(dots) for dots in entry['dot_sites']),
+        }
+        return types.FunctionType(entry['code'], namespace, 'render_function')
+
+    def _compile(self, text, mode='render'):
+        """
+        把模板编译成render_function，返回一个可以被marshal序列化的字典。
+
+        mode为'stream'时，render_function是一个生成器，边渲染边yield字符串片段；
+        mode为'async'时，render_function是一个协程函数，表达式里的可等待对象都会被await。
+        """
+        stream = mode == 'stream'
+        self._async = mode == 'async'
+        self._profile = self.profiler is not None
 
         self.all_vars = set() # 所有的变量的集合
         self.loop_vars = set() # for循环变量的集合，比如for i in range(10):，这个i就要被添加到loop_vars中。
+        self.dot_sites = [] # inline_dots模式下，每一处取点操作的属性名元组
+        self.deps = {} # extends和include用到的模板，{名字: 源码的哈希}
 
         # 定义一个函数字符串，以供执行。
         code = CodeBuilder()
 
-        code.add_line("def render_function(context, do_dots):")
+        if self._async:
+            code.add_line("async def render_function(context, do_dots):")
+        else:
+            code.add_line("def render_function(context, do_dots):")
         code.indent()
         vars_code = code.add_section()
         code.add_line("result = []")
@@ -128,10 +828,18 @@ class Templite(object):
             del buffered[:]
 
         ops_stack = [] # 这是一个栈
+        cache_stack = [] # {% cache %}标签的编号和ttl，和ops_stack里的'cache'一一对应
+        for_stack = [] # 开启了profile时，for循环的编号和描述
+        for_count = 0
+        escape_in_loop = False # 循环里有没有需要转义的输出
 
-        # 将模板text用正则匹配出一系列token。
-        # '?s'为单行模式
-        tokens = re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", text)
+        # 把extends、block、include都展开，得到一串只有if、for、cache的token。
+        tokens = self._link(text)
+        # 片段缓存的key里带上模板的指纹，不同模板的同名片段不会冲突；
+        # 转不转义输出也不一样，所以autoescape也算在指纹里
+        fingerprint = hashlib.sha1(
+            ("autoescape=%d\n" % self.autoescape + "".join(tokens)).encode('utf-8')
+        ).hexdigest()[:16]
 
         for token in tokens:
             if token.startswith('{#'):
@@ -139,9 +847,15 @@ class Templite(object):
                 continue
             elif token.startswith('{{'):
                 # 碰到两个花括号说明是需要求值
-                expr = self._expr_code(token[2:-2].strip())
-                print('expr: ', expr)
-                buffered.append("to_str(%s)" % expr)
+                expr = token[2:-2].strip()
+                if not self.autoescape or expr.endswith('|safe'):
+                    # 最后一个过滤器是safe，编译时就知道不用转义了
+                    buffered.append("to_str(%s)" % self._expr_code(expr))
+                elif 'for' in ops_stack:
+                    escape_in_loop = True
+                    buffered.append("escape_memo(%s)" % self._expr_code(expr))
+                else:
+                    buffered.append("escape(%s)" % self._expr_code(expr))
             elif token.startswith('{%'):
                 # 碰到'{%'说明不是if就是for
                 flush_output()
@@ -160,13 +874,30 @@ class Templite(object):
                         self._syntax_error("for语句编写有问题", token)
                     ops_stack.append('for') # 入栈for
                     self._variable(words[1], self.loop_vars)
-                    code.add_line(
-                        "for c_%s in %s:" % (
-                            words[1],
-                            self._expr_code(words[3])
-                        )
-                    )
+                    iterable = self._expr_code(words[3])
+                    if self._async:
+                        iterable = "await gather_items(%s)" % iterable
+                    if self._profile:
+                        for_stack.append((for_count, " ".join(words)))
+                        code.add_line("for_start_%d = perf_counter()" % for_count)
+                        for_count += 1
+                    code.add_line("for c_%s in %s:" % (words[1], iterable))
+                    code.indent()
+                elif words[0] == 'cache':
+                    # {% cache name ttl expr1 expr2 ... %}
+                    if len(words) < 3 or not words[2].isdigit():
+                        self._syntax_error("cache语句编写有问题", token)
+                    ops_stack.append('cache') # 入栈cache
+                    index = len(cache_stack)
+                    cache_stack.append((index, int(words[2])))
+                    key_parts = ['fragment_scope', repr(fingerprint), repr(words[1].strip('"\''))]
+                    key_parts.extend("vary_key(%s)" % self._expr_code(w) for w in words[3:])
+                    code.add_line("frag_key_%d = (%s)" % (index, ", ".join(key_parts)))
+                    code.add_line("frag_%d = fragments.get(frag_key_%d)" % (index, index))
+                    code.add_line("if frag_%d is None:" % index)
                     code.indent()
+                    # 记下片段开始的位置，结束时把这之后的内容切出来存进缓存
+                    code.add_line("frag_mark_%d = len(result)" % index)
                 elif words[0].startswith('end'):
                     # 不管是endif或者endfor，都必须以end开头。
                     if len(words) != 1:
@@ -177,7 +908,30 @@ class Templite(object):
                     start_what = ops_stack.pop() # 出栈if或者for
                     if start_what != end_what:
                         self._syntax_error("end符号不能匹配if或者for", end_what)
+                    if end_what == 'cache':
+                        index, ttl = cache_stack.pop()
+                        code.add_line("frag_%d = ''.join(result[frag_mark_%d:])" % (index, index))
+                        code.add_line("del result[frag_mark_%d:]" % index)
+                        code.add_line("fragments.set(frag_key_%d, frag_%d, %d)" % (index, index, ttl))
+                        code.dedent()
+                        code.add_line("append_result(frag_%d)" % index)
+                        continue
+                    # cache块里面不能yield，不然片段开始的位置就对不上了
+                    if stream and end_what == 'for' and 'cache' not in ops_stack:
+                        # 每次迭代结束检查一下，攒够了就吐出去，然后清空result
+                        code.add_line(
+                            "if len(result) >= %d:" % self.STREAM_FLUSH_FRAGMENTS
+                        )
+                        code.indent()
+                        code.add_line("yield ''.join(result)")
+                        code.add_line("del result[:]")
+                        code.dedent()
                     code.dedent()
+                    if self._profile and end_what == 'for':
+                        index, label = for_stack.pop()
+                        code.add_line(
+                            "probe.record('for', %r, perf_counter() - for_start_%d)" % (label, index)
+                        )
                 else:
                     self._syntax_error("无法理解的标签", words[0])
             else:
@@ -192,12 +946,139 @@ class Templite(object):
 
         for var_name in self.all_vars - self.loop_vars: # 去掉循环中的变量，剩下的变量
             vars_code.add_line("c_%s = context[%r]" % (var_name, var_name))
+        if escape_in_loop:
+            vars_code.add_line("escape_memo = make_escape_memo()")
+        for index in range(len(self.dot_sites)):
+            # 把取值函数从全局变量拿到局部变量里，循环中访问更快
+            vars_code.add_line("dots_%d = dot_sites[%d]" % (index, index))
 
-        code.add_line("return ''.join(result)")
+        if stream:
+            code.add_line("if result:")
+            code.indent()
+            code.add_line("yield ''.join(result)")
+            code.dedent()
+            code.add_line("return")
+        else:
+            code.add_line("return ''.join(result)")
         code.dedent()
-        print(code)
-        print(code.get_globals()['render_function'])
-        self._render_function = code.get_globals()['render_function']
+        render_function = code.get_globals()['render_function']
+        return {
+            'code': render_function.__code__,
+            'all_vars': frozenset(self.all_vars),
+            'loop_vars': frozenset(self.loop_vars),
+            'dot_sites': tuple(self.dot_sites),
+            'deps': self.deps,
+        }
+
+    def _tokenize(self, text):
+        """将模板text用正则匹配出一系列token。'?s'为单行模式"""
+        return re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", text)
+
+    def _tag_words(self, token):
+        """如果token是{% %}标签，返回里面的单词列表，否则返回None"""
+        if token.startswith('{%'):
+            return token[2:-2].strip().split() or None
+        return None
+
+    def _tag_name(self, words, token):
+        """extends、block、include后面跟的名字，可以带引号"""
+        if len(words) != 2:
+            self._syntax_error("%s语句编写有问题" % words[0], token)
+        return words[1].strip('"\'')
+
+    def _load_source(self, name):
+        """通过loader加载模板源码，并记录到deps里"""
+        if self.loader is None:
+            self._syntax_error("没有loader，不能加载模板", name)
+        source = self.loader.get_source(name)
+        self.deps[name] = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        return source
+
+    def _deps_fresh(self, deps):
+        """缓存里的编译结果依赖的模板有没有变过，变了就要重新编译"""
+        for name, digest in deps.items():
+            try:
+                source = self.loader.get_source(name)
+            except (AttributeError, TemplateNotFound):
+                return False
+            if hashlib.sha1(source.encode('utf-8')).hexdigest() != digest:
+                return False
+        return True
+
+    def _link(self, text, overrides=None, stack=()):
+        """
+        在编译之前处理extends、block和include，返回展开后的token列表。
+
+        overrides是子模板定义的block，{名字: token列表}，stack用来检查循环引用。
+        """
+        tokens = self._tokenize(text)
+        for i, token in enumerate(tokens):
+            words = self._tag_words(token)
+            if words and words[0] == 'extends':
+                # extends前面只能有空白和注释
+                for before in tokens[:i]:
+                    if before.strip() and not before.startswith('{#'):
+                        self._syntax_error("extends必须是模板的第一个标签", token)
+                parent = self._tag_name(words, token)
+                if parent in stack:
+                    self._syntax_error("模板循环继承", parent)
+                # 子模板的block优先，所以用子模板的覆盖当前模板的
+                blocks = self._collect_blocks(tokens[i + 1:])
+                blocks.update(overrides or {})
+                return self._link(self._load_source(parent), blocks, stack + (parent,))
+        return self._expand(tokens, overrides or {}, stack)
+
+    def _find_endblock(self, tokens, start):
+        """找到和tokens[start]这个block配对的endblock的下标"""
+        depth = 0
+        for i in range(start, len(tokens)):
+            words = self._tag_words(tokens[i])
+            if not words:
+                continue
+            if words[0] == 'block':
+                depth += 1
+            elif words[0] == 'endblock':
+                depth -= 1
+                if depth == 0:
+                    return i
+        self._syntax_error("block没有对应的endblock", tokens[start])
+
+    def _collect_blocks(self, tokens):
+        """收集所有的block（包括嵌套的），返回{名字: block里面的token列表}"""
+        blocks = {}
+        for i, token in enumerate(tokens):
+            words = self._tag_words(token)
+            if words and words[0] == 'block':
+                end = self._find_endblock(tokens, i)
+                blocks[self._tag_name(words, token)] = tokens[i + 1:end]
+        return blocks
+
+    def _expand(self, tokens, overrides, stack):
+        """展开block和include，block的内容如果被子模板覆盖了就用子模板的"""
+        result = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            words = self._tag_words(token)
+            if words and words[0] == 'block':
+                end = self._find_endblock(tokens, i)
+                name = self._tag_name(words, token)
+                body = overrides.get(name, tokens[i + 1:end])
+                result.extend(self._expand(body, overrides, stack))
+                i = end + 1
+                continue
+            elif words and words[0] == 'include':
+                name = self._tag_name(words, token)
+                if name in stack:
+                    self._syntax_error("模板循环包含", name)
+                # 被包含的模板是独立的，不受当前模板的block影响
+                result.extend(self._link(self._load_source(name), None, stack + (name,)))
+            elif words and words[0] in ('endblock', 'extends'):
+                self._syntax_error("无法匹配的动作标签", token)
+            else:
+                result.append(token)
+            i += 1
+        return result
 
     def _expr_code(self, expr):
         """产生一个可供执行的python表达式"""
@@ -205,13 +1086,40 @@ class Templite(object):
             pipes = expr.split("|")
             code = self._expr_code(pipes[0]) # 递归调用
             for func in pipes[1:]:
+                if func == 'safe':
+                    # 内置的safe过滤器，不需要在context里定义
+                    code = "Markup(%s)" % code
+                    continue
                 self._variable(func, self.all_vars)
-                code = "c_%s(%s)" % (func, code)
+                if self._profile:
+                    call = "probe.acall" if self._async else "probe.call"
+                    code = "%s('filter', %r, c_%s, %s)" % (call, func, func, code)
+                    if self._async:
+                        code = "await " + code
+                elif self._async:
+                    code = "await await_value(c_%s(%s))" % (func, code)
+                else:
+                    code = "c_%s(%s)" % (func, code)
         elif "." in expr:
             dots = expr.split(".")
             code = self._expr_code(dots[0]) # 递归调用
             args = ", ".join(repr(d) for d in dots[1:])
-            code = "do_dots(%s, %s)" % (code, args)
+            if self._async:
+                # 异步模式下每一步都可能要await，用不上按类型特化的取值函数；
+                # 这时的do_dots是这次渲染的_AwaitMemo.do_dots
+                func, args = "do_dots", "%s, %s" % (code, args)
+            elif self.inline_dots:
+                func, args = "dots_%d" % len(self.dot_sites), code
+                self.dot_sites.append(tuple(dots[1:]))
+            else:
+                func, args = "do_dots", "%s, %s" % (code, args)
+            if self._profile:
+                call = "probe.acall" if self._async else "probe.call"
+                code = "%s('dots', %r, %s, %s)" % (call, expr, func, args)
+            else:
+                code = "%s(%s)" % (func, args)
+            if self._async:
+                code = "await " + code
         else:
             self._variable(expr, self.all_vars)
             code = "c_%s" % expr
@@ -233,18 +1141,143 @@ class Templite(object):
         """
         render函数，和django中的render类似，context和django中的context也一样。
         """
-        # Make the complete context we'll use.
+        if self.profiler is None:
+            return self._render_function(self._make_context(context), self._do_dots)
+        start = time.perf_counter()
+        try:
+            return self._render_function(self._make_context(context), self._do_dots)
+        finally:
+            self.profiler.record_render(self.name, time.perf_counter() - start)
+
+    def render_iter(self, context=None, chunk_size=8192):
+        """
+        流式渲染，返回一个生成器，每次产出大约chunk_size个字符。
+
+        和render的结果拼起来是一样的，但不会把整页都放在内存里，第一块也能更早发出去。
+        """
+        if self._stream_function is None:
+            self._stream_function = self._load_function('stream')
+        # 流式渲染的耗时只算模板自己的，不算调用方处理每一块的时间
+        elapsed = 0.0
+        start = time.perf_counter()
+        pieces = []
+        size = 0
+        for piece in self._stream_function(self._make_context(context), self._do_dots):
+            pieces.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                elapsed += time.perf_counter() - start
+                yield ''.join(pieces)
+                start = time.perf_counter()
+                pieces = []
+                size = 0
+        elapsed += time.perf_counter() - start
+        if self.profiler is not None:
+            self.profiler.record_render(self.name, elapsed)
+        if pieces:
+            yield ''.join(pieces)
+
+    async def render_async(self, context=None):
+        """
+        异步渲染。
+
+        先把模板用到的、值是可等待对象的变量一起gather，总耗时取决于最慢的那一个，
+        而不是所有查询的耗时之和；渲染过程中取点操作和过滤器返回的可等待对象也会被await。
+        """
+        if self._async_function is None:
+            self._async_function = self._load_function('async')
+        start = time.perf_counter()
+        render_context = self._make_context(context)
+        names = [
+            name for name in self.all_vars - self.loop_vars
+            if inspect.isawaitable(render_context.get(name))
+        ]
+        if names:
+            values = await asyncio.gather(*(render_context[name] for name in names))
+            render_context.update(zip(names, values))
+        try:
+            return await self._async_function(render_context, _AwaitMemo().do_dots)
+        finally:
+            if self.profiler is not None:
+                self.profiler.record_render(self.name, time.perf_counter() - start)
+
+    def render_to(self, fp, context=None, chunk_size=8192):
+        """
+        把渲染结果分块写到一个类文件对象里（只要有write方法就行），返回写入的字符数。
+        """
+        written = 0
+        for chunk in self.render_iter(context, chunk_size):
+            fp.write(chunk)
+            written += len(chunk)
+        return written
+
+    def render_many(self, contexts, processes=None, chunksize=64):
+        """
+        用同一个模板渲染一批context，返回一个生成器，按顺序产出渲染结果。
+
+        公共的那部分context只准备一次，而且只保留模板用得到的变量，每个context只需要拷贝一个小字典。
+        processes大于1时用进程池：编译好的模板在每个子进程初始化时发过去一次，
+        之后只传context和结果。这时全局context里的过滤器、contexts里的值都必须能被pickle。
+        传了profiler的话，子进程里的渲染耗时和标签统计也会记到这个profiler里。
+        """
+        if processes is not None and processes > 1:
+            return self._render_many_parallel(contexts, processes, chunksize)
+        return self._render_many_serial(contexts)
+
+    def _base_context(self):
+        """全局context里模板真正用得到的那部分"""
+        needed = self.all_vars - self.loop_vars
+        return {name: self.context[name] for name in needed if name in self.context}
+
+    def _render_many_serial(self, contexts):
+        base = self._base_context()
+        render_function = self._render_function
+        do_dots = self._do_dots
+        profiler = self.profiler
+        for context in contexts:
+            start = time.perf_counter()
+            render_context = dict(base)
+            if context:
+                render_context.update(context)
+            text = render_function(render_context, do_dots)
+            if profiler is not None:
+                profiler.record_render(self.name, time.perf_counter() - start)
+            yield text
+
+    def _render_many_parallel(self, contexts, processes, chunksize):
+        key, entry = self._compiled['render']
+        # 缓存key里的选项都要发过去，子进程用同样的选项构造Templite，key才能对上，
+        # 否则子进程会按默认选项重新编译，比如丢掉autoescape。code对象不能pickle，但是可以marshal
+        options = {
+            'name': self.name,
+            'inline_dots': self.inline_dots,
+            'autoescape': self.autoescape,
+            'profile': self.profiler is not None,
+        }
+        payload = (self.text, self.context, options, self.loader, key, marshal.dumps(entry))
+        with multiprocessing.Pool(processes, _init_render_worker, (payload,)) as pool:
+            # imap是惰性的，结果按顺序一个一个地流回来
+            if self.profiler is None:
+                for text in pool.imap(_render_in_worker, contexts, chunksize):
+                    yield text
+                return
+            # 开了profile时子进程把每次渲染的耗时和标签统计一起发回来，记到主进程的profiler里
+            for text, seconds, tags in pool.imap(_render_in_worker, contexts, chunksize):
+                self.profiler.record_render(self.name, seconds)
+                self.profiler.record_tags(self.name, tags)
+                yield text
+
+    def _make_context(self, context):
+        """Make the complete context we'll use."""
         render_context = dict(self.context)
         if context:
             render_context.update(context)
-        return self._render_function(render_context, self._do_dots)
+        return render_context
 
     def _do_dots(self, value, *dots):
         """
         在运行时求值，主要用来处理'.'操作符。dots为key值，比如product.id，那么id就是dots。
         """
-        print('value: ', value)
-        print('dots: ', dots)
         for dot in dots:
             try:
                 value = getattr(value, dot)
@@ -254,6 +1287,44 @@ class Templite(object):
                 value = value()
         return value
 
+# render_many的进程池里，每个子进程都有一份自己的模板
+_worker_template = None
+_worker_base = None
+_worker_profiler = None
+
+
+def _init_render_worker(payload):
+    """子进程初始化：用主进程发过来的编译结果预先填好缓存，这样构造Templite时不会再编译"""
+    global _worker_template, _worker_base, _worker_profiler
+    text, context, options, loader, key, entry = payload
+    cache = TemplateCache(maxsize=1)
+    cache.set(key, marshal.loads(entry))
+    _worker_profiler = Profiler() if options['profile'] else None
+    _worker_template = Templite(
+        text, context, cache=cache, loader=loader, name=options['name'],
+        inline_dots=options['inline_dots'], autoescape=options['autoescape'],
+        profiler=_worker_profiler,
+    )
+    if _worker_template._compiled['render'][0] != key:
+        raise RuntimeError("render_many的子进程和主进程编译模板的选项不一致")
+    _worker_base = _worker_template._base_context()
+
+
+def _render_in_worker(context):
+    render_context = dict(_worker_base)
+    if context:
+        render_context.update(context)
+    if _worker_profiler is None:
+        return _worker_template._render_function(render_context, _worker_template._do_dots)
+    start = time.perf_counter()
+    text = _worker_template._render_function(render_context, _worker_template._do_dots)
+    seconds = time.perf_counter() - start
+    # 只把这一次的标签统计发回去，发完就清掉
+    stats = _worker_profiler.stats().get(_worker_template.name)
+    _worker_profiler.reset()
+    return text, seconds, stats['tags'] if stats else {}
+
+
 if __name__ == '__main__':
     templite = Templite('''
         <h1>Hello {{name|upper}}!</h1>
@@ -271,4 +1342,4 @@ if __name__ == '__main__':
         'topics': ['Python', 'Javascript'],
         'product': {'id': func},
     })
-    print(text)
\ No newline at end of file
+    print(text)